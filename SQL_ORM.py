@@ -1,5 +1,10 @@
+import itertools
 import sqlite3
-import copy
+import threading
+import time
+from slow_query_log import SlowQueryLog
+from hot_copy import HotCopy
+from group_commit import GroupCommit
 
 
 class LimitError(Exception):
@@ -7,8 +12,19 @@ class LimitError(Exception):
     pass
 
 
+class QueryTimeout(sqlite3.OperationalError):
+    """An exception to show a query was aborted because it ran past the deadline of its thread."""
+    pass
+
+
+class ResultTooLarge(sqlite3.Error):
+    """An exception to show the rows of a query were more than the size limit of its thread."""
+    pass
+
+
 class ID(object):
-    """Used to create primary keys in SQL."""
+    """Used to create primary keys in SQL.
+    An ID object can be shared between threads."""
     def __init__(self, start=1, limit=None, jump=1):
         """Create a new object that will returns different primary keys each time.
         Use start to start at a number other than 1.
@@ -20,6 +36,7 @@ class ID(object):
         if jump == 0:
             raise ValueError("'jump' cannot be 0.")
         self._jump = jump
+        self._lock = threading.Lock()
 
     @property
     def limit(self):
@@ -31,26 +48,38 @@ class ID(object):
         """Get the jump for the ID."""
         return self._jump
 
+    @property
+    def next_id(self):
+        """The ID the next call to get_next will return (the high-water mark)."""
+        return self._current
+
     def get_next(self):
         """Get the next ID."""
-        ret_current = copy.copy(self._current)
-        self._current += self._jump
-
-        if self._limit is None:
-            return ret_current
-
-        if self._jump > 0:
-            if ret_current > self._limit:
-                raise LimitError("Next ID is over the limit.")
-            return ret_current
-
-        if self._jump < 0:
-            if ret_current < self._limit:
-                raise LimitError("Next ID is under the limit.")
-            return ret_current
-
-        else:   # Should not be able to get here, means self._jump = 0.
-            raise ValueError("'jump' is equal to 0.")
+        return self.reserve(1)[0]
+
+    def skip_to(self, start):
+        """Make sure no ID before start (after it, for a negative 'jump') is returned from now on,
+        like when rows were added with IDs this object did not hand out."""
+        with self._lock:
+            if (start - self._current) * self._jump > 0:
+                self._current = start
+
+    def reserve(self, count):
+        """Reserve a block of count IDs and return them as a list.
+        The IDs are contiguous (separated by 'jump'), and no other call will return any of them.
+        If the last ID in the block is over (or under) the limit, LimitError is raised and nothing is reserved."""
+        if count < 1:
+            raise ValueError("'count' must be at least 1.")
+        with self._lock:
+            last = self._current + self._jump * (count - 1)
+            if self._limit is not None:
+                if self._jump > 0 and last > self._limit:
+                    raise LimitError("Next ID is over the limit.")
+                if self._jump < 0 and last < self._limit:
+                    raise LimitError("Next ID is under the limit.")
+            block = range(self._current, last + self._jump, self._jump)
+            self._current = last + self._jump
+        return block
 
 
 class Conference(object):
@@ -323,13 +352,112 @@ class Player(object):
 
 
 class ORM(object):
-    def __init__(self, db_name="ORM"):
+    added = "ADD"
+    updated = "UPDATE"
+    deleted = "DELETE"
+
+    changelog_limit = 100000    # Entries kept in the changelog when it is compacted.
+    compact_every = 1000    # Writes through change between automatic changelog compactions.
+    deadline_check_every = 1000     # SQLite instructions between checks of the deadline.
+    roster_version = 1  # PRAGMA user_version of DBs with the current Roster triggers (see _start_roster).
+
+    def __init__(self, db_name="ORM", hot=False, async_writes=False):
+        """db_name is the name of the DB file excluding .db.
+        If hot is True, the DB is loaded into memory and queries are answered from there,
+        while writes go to both memory and the file (see hot_copy.HotCopy, async_writes is passed to it).
+        All threads share the in-memory connection, so their queries run one at a time."""
+        self._local = threading.local()     # Every thread gets its own connection.
         self.conn = None  # will store the DB connection
         self.cursor = None   # will store the DB connection cursor
         self.db_name = db_name  # The name of the data base with no .db at the end.
         self.team = TeamORM(self)
         self.player = PlayerORM(self)
+        self.roster = RosterORM(self)
+        self._allocators = {}
+        self._allocators_lock = threading.Lock()
+        self._listeners = []    # (listener, wants_rows) tuples.
+        self._writes = itertools.count(1)   # Counts the writes of change, next() is atomic.
+        self._compacting = threading.Lock()
+        self.slow_log = None    # See log_slow_queries.
+        self.group_commit = None    # See group_commits.
+        # Always the same object: the sqlite3 module keeps only the first of equal handlers alive.
+        self._progress_handler = self._overdue
+        self.hot = None
         self.start_db()
+        if hot:
+            self.hot = HotCopy(self.db_name + ".db", async_writes)
+            # Set once for good: all threads share the connection, and the handler checks the deadline
+            # of the thread running the query, so one thread's open never removes another's.
+            conn, cursor = self.hot.acquire()
+            try:
+                conn.set_progress_handler(self._progress_handler, ORM.deadline_check_every)
+            finally:
+                self.hot.release()
+
+    @property
+    def conn(self):
+        """The DB connection of the current thread."""
+        return getattr(self._local, "conn", None)
+
+    @conn.setter
+    def conn(self, value):
+        self._local.conn = value
+
+    @property
+    def deadline(self):
+        """The time (like time.time) after which the queries of the current thread are aborted, or None."""
+        return getattr(self._local, "deadline", None)
+
+    def set_deadline(self, seconds):
+        """Abort the queries the current thread runs more than seconds from now with QueryTimeout,
+        until set_deadline is called again. None removes the deadline.
+        Writes made with group_commits on run on the thread of GroupCommit, so they have no deadline."""
+        self._local.deadline = None if seconds is None else time.time() + seconds
+
+    def _overdue(self):
+        """SQLite progress handler, that aborts the query when the deadline of the thread passed.
+        SQLite calls it on the thread running the query, so it is the deadline of the thread that made it."""
+        deadline = self.deadline
+        return deadline is not None and time.time() > deadline
+
+    @property
+    def size_limit(self):
+        """The most bytes of values the queries of the current thread may return, or None."""
+        return getattr(self._local, "size_limit", None)
+
+    def set_size_limit(self, size):
+        """Stop reading the rows of the queries the current thread runs with ResultTooLarge once their values
+        are more than size bytes (strings count their length, other values one byte),
+        until set_size_limit is called again. None removes the limit."""
+        self._local.size_limit = size
+
+    def _fetch(self, rows, func=None):
+        """Returns a list with func called with each of the rows (an iterable like a cursor),
+        or with the rows themselves if func is None, checking the size limit of the thread while reading them."""
+        limit = self.size_limit
+        fetched = []
+        size = 0
+        for row in rows:
+            if limit is not None:
+                size += sum(len(value) if isinstance(value, basestring) else 1 for value in row)
+                if size > limit:
+                    raise ResultTooLarge(size)
+            fetched.append(row if func is None else func(row))
+        return fetched
+
+    def _check_timeout(self, error):
+        """Raises QueryTimeout instead of the sqlite3.Error a query raised, if it was aborted for its deadline."""
+        if isinstance(error, sqlite3.OperationalError) and self.deadline is not None and time.time() > self.deadline:
+            raise QueryTimeout("The query ran past its deadline.")
+
+    @property
+    def cursor(self):
+        """The DB connection cursor of the current thread."""
+        return getattr(self._local, "cursor", None)
+
+    @cursor.setter
+    def cursor(self, value):
+        self._local.cursor = value
 
     def start_db(self):
         """Manages the opening of a the DB."""
@@ -358,24 +486,140 @@ class ORM(object):
                             "team_id INTEGER," +
                             "FOREIGN KEY(team_id) REFERENCES Teams(id)" +
                             ");")
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS IDs" +
+                            "(" +
+                            "name TEXT PRIMARY KEY," +
+                            "next INTEGER" +
+                            ");")
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS Changelog" +
+                            "(" +
+                            "seq INTEGER PRIMARY KEY AUTOINCREMENT," +
+                            "tbl TEXT," +
+                            "row_id INTEGER," +
+                            "action TEXT" +
+                            ");")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS ChangelogByTable ON Changelog (tbl, seq);")
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS ChangelogHorizon (seq INTEGER);")
+        for table in ("Teams", "Players"):    # The log is written by SQLite, in the same transaction as the change.
+            self.cursor.execute("CREATE TRIGGER IF NOT EXISTS {0}Added AFTER INSERT ON {0} BEGIN "
+                                "INSERT INTO Changelog (tbl, row_id, action) VALUES ('{0}', NEW.id, '{1}'); "
+                                "END;".format(table, ORM.added))
+            self.cursor.execute("CREATE TRIGGER IF NOT EXISTS {0}Updated AFTER UPDATE ON {0} BEGIN "
+                                "INSERT INTO Changelog (tbl, row_id, action) VALUES ('{0}', NEW.id, '{1}'); "
+                                "END;".format(table, ORM.updated))
+            self.cursor.execute("CREATE TRIGGER IF NOT EXISTS {0}Deleted AFTER DELETE ON {0} BEGIN "
+                                "INSERT INTO Changelog (tbl, row_id, action) VALUES ('{0}', OLD.id, '{1}'); "
+                                "END;".format(table, ORM.deleted))
+        self._start_roster()
         self.commit()
         self.close()
 
+    def _start_roster(self):
+        """Creates the Roster table, which has every player with the details of its team, so players with their
+        teams are read with one indexed query. Triggers keep it up to date with Players and Teams.
+        Players without a team (or with an unknown team_id) are kept with NULL team columns.
+        Must be called with the DB open."""
+        team_columns = ("state", "city", "division", "arena", "championships", "website")
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS Roster" +
+                            "(" +
+                            "id INTEGER PRIMARY KEY," +
+                            "first_name TEXT," +
+                            "last_name TEXT," +
+                            "number INTEGER," +
+                            "age INTEGER," +
+                            "rings INTEGER," +
+                            "nationality TEXT," +
+                            "team_id INTEGER," +
+                            "team_name TEXT," +
+                            "state TEXT," +
+                            "city TEXT," +
+                            "division TEXT," +
+                            "arena TEXT," +
+                            "championships INTEGER," +
+                            "website TEXT" +
+                            ");")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS RosterByTeam ON Roster (team_id);")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS RosterByTeamName ON Roster (team_name);")
+        teams = ", ".join("Teams." + column for column in team_columns)
+        new_player = ("NEW.id, NEW.first_name, NEW.last_name, NEW.number, NEW.age, NEW.rings, NEW.nationality, "
+                      "NEW.team_id")
+        add_player = ("INSERT OR REPLACE INTO Roster SELECT {}, Teams.name, {} FROM (SELECT 1) "
+                      "LEFT JOIN Teams ON Teams.id = NEW.team_id;".format(new_player, teams))
+        triggers = {"RosterPlayerAdded": "AFTER INSERT ON Players BEGIN " + add_player + " END;",
+                    "RosterPlayerUpdated": "AFTER UPDATE ON Players BEGIN "
+                                           "DELETE FROM Roster WHERE id = OLD.id; " + add_player + " END;",
+                    "RosterPlayerDeleted": "AFTER DELETE ON Players BEGIN DELETE FROM Roster WHERE id = OLD.id; END;",
+                    "RosterTeamAdded": "AFTER INSERT ON Teams BEGIN INSERT OR REPLACE INTO Roster "
+                                       "SELECT *, NEW.name, {} FROM Players WHERE team_id = NEW.id; END;"
+                                       .format(", ".join("NEW." + column for column in team_columns)),
+                    "RosterTeamUpdated": "AFTER UPDATE ON Teams BEGIN UPDATE Roster SET team_id = NEW.id, "
+                                         "team_name = NEW.name, {} WHERE team_id = OLD.id; END;"
+                                         .format(", ".join("{0} = NEW.{0}".format(column)
+                                                           for column in team_columns)),
+                    "RosterTeamDeleted": "AFTER DELETE ON Teams BEGIN UPDATE Roster SET team_name = NULL, {} "
+                                         "WHERE team_id = OLD.id; END;"
+                                         .format(", ".join(column + " = NULL" for column in team_columns))}
+        for name, trigger in triggers.iteritems():
+            self.cursor.execute("CREATE TRIGGER IF NOT EXISTS {} {}".format(name, trigger))
+        if self.cursor.execute("PRAGMA user_version;").fetchone()[0] >= ORM.roster_version:
+            return
+        # A new DB, or one made before the current triggers: replace them and fill the table again,
+        # in one transaction so no write made meanwhile is missed.
+        self.conn.isolation_level = None    # Or the sqlite3 module commits before every DROP and CREATE.
+        try:
+            self.cursor.execute("BEGIN IMMEDIATE;")
+            try:
+                if self.cursor.execute("PRAGMA user_version;").fetchone()[0] < ORM.roster_version:  # Not by others.
+                    for name, trigger in triggers.iteritems():
+                        self.cursor.execute("DROP TRIGGER IF EXISTS {};".format(name))
+                        self.cursor.execute("CREATE TRIGGER {} {}".format(name, trigger))
+                    self.cursor.execute("DELETE FROM Roster;")
+                    self.cursor.execute("INSERT INTO Roster SELECT Players.*, Teams.name, {} FROM Players "
+                                        "LEFT JOIN Teams ON Teams.id = Players.team_id;".format(teams))
+                    self.cursor.execute("PRAGMA user_version = {};".format(ORM.roster_version))
+                self.cursor.execute("COMMIT;")
+            except sqlite3.Error:
+                self.cursor.execute("ROLLBACK;")
+                raise
+        finally:
+            self.conn.isolation_level = ""
+
     def open(self):
         """
         will open DB file and put value in:
         self.conn (need DB file name)
         and self.cursor
         """
-        self.conn = sqlite3.connect(self.db_name + ".db")
-        self.cursor = self.conn.cursor()
-        self.cursor.execute("PRAGMA foreign_keys = ON;")
-        
+        if self.hot is not None:
+            self.conn, self.cursor = self.hot.acquire()     # Shared by all threads, until close.
+        else:
+            self.conn = sqlite3.connect(self.db_name + ".db")
+            self.cursor = self.conn.cursor()
+            self.cursor.execute("PRAGMA foreign_keys = ON;")
+        if self.deadline is not None and self.hot is None:   # The hot copy has it set already.
+            self.conn.set_progress_handler(self._progress_handler, ORM.deadline_check_every)
+
     def close(self):
+        if self.hot is not None:
+            self.hot.release()
+            return
         self.conn.close()
 
     def commit(self):
-        self.conn.commit()
+        if self.hot is not None:
+            self.hot.commit()   # Writes the file too, see HotCopy.commit.
+        else:
+            self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+        if self.hot is not None:
+            self.hot.rolled_back()
+
+    def flush(self):
+        """With a hot copy with async_writes, waits until all the writes are written to the file."""
+        if self.hot is not None:
+            self.hot.flush()
 
     @staticmethod
     def constraints_to_tuples(**constraints):
@@ -407,20 +651,212 @@ class ORM(object):
         calls func (callable) with each item the query returns and returns a list with all the results of func.
         Use this to retrieve information from the DB."""
         self.open()
-        cursor_objs = self.cursor.execute(query, values)
-        if func is not None:
-            cursor_objs = [func(obj) for obj in cursor_objs]
-        self.close()
+        try:
+            start = time.time()
+            cursor_objs = self._fetch(self.cursor.execute(query, values), func)
+        except sqlite3.Error as e:
+            self._check_timeout(e)
+            raise
+        finally:
+            self.close()
+        if self.slow_log is not None:
+            self.slow_log.observe(query, values, len(cursor_objs), time.time() - start)
         return cursor_objs
 
+    def stream(self, query, func=None, values=(), batch_size=1000):
+        """Like select, but a generator that fetches the results batch_size rows at a time,
+        so tables of any size can be read in constant memory.
+        It uses its own connection to the file (even with a hot copy), closed when the generator is exhausted
+        or closed."""
+        conn = sqlite3.connect(self.db_name + ".db")
+        try:
+            cursor = conn.execute(query, values)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row if func is None else func(row)
+        finally:
+            conn.close()
+
     def change(self, query, values=()):
         """Executes the query (using sqlite's second tuple parameter to replace ?s with values) and commits.
-        No value is returned and there is no protection against crashes, so you can handle it yourself.
-        Use this to make changes to the DB."""
+        Returns the rowid of the last inserted row and there is no protection against crashes,
+        so you can handle it yourself.
+        Use this to make changes to the DB.
+        With group_commits on, the query is committed together with the writes of other threads."""
+        start = time.time()
+        if self.group_commit is not None:
+            row_id, rows = self.group_commit.change(query, values)
+        else:
+            self.open()
+            try:
+                self.cursor.execute(query, values)
+                row_id = self.cursor.lastrowid
+                rows = self.cursor.rowcount
+                self.commit()
+            except sqlite3.Error as e:
+                self._check_timeout(e)
+                raise
+            finally:
+                self.close()
+        if self.slow_log is not None:
+            self.slow_log.observe(query, values, rows, time.time() - start)
+        if self.compact_every and next(self._writes) % self.compact_every == 0:
+            self._compact_in_background()
+        return row_id
+
+    def _compact_in_background(self):
+        """Starts compact_changelog on its own thread, so the write that reached compact_every does not wait
+        for it. Does nothing if a compaction is running already."""
+        if not self._compacting.acquire(False):
+            return
+        thread = threading.Thread(target=self._compact)
+        thread.daemon = True
+        thread.start()
+
+    def _compact(self):
+        """The thread of _compact_in_background."""
+        try:
+            self.compact_changelog()
+        except sqlite3.Error:
+            pass    # Tried again after the next compact_every writes.
+        finally:
+            self._compacting.release()
+
+    def log_slow_queries(self, out, threshold=0.1, sample_rate=1.0):
+        """Start logging the queries of select and change that take at least threshold seconds to out
+        (a path or an object with write and flush methods), with their plans. See SlowQueryLog."""
+        self.stop_logging_slow_queries()
+        self.slow_log = SlowQueryLog(self.db_name + ".db", out, threshold, sample_rate)
+
+    def stop_logging_slow_queries(self):
+        """Stop the log started with log_slow_queries, after writing the queries waiting to be logged."""
+        slow_log, self.slow_log = self.slow_log, None
+        if slow_log is not None:
+            slow_log.close()
+
+    def group_commits(self, window=0.002, max_writes=100):
+        """Start committing the writes of change (add, update and delete) in groups: the writes that threads make
+        within window seconds of each other, up to max_writes, are committed in one transaction.
+        Every write still waits for its commit and fails alone. See GroupCommit."""
+        self.stop_group_commits()
+        self.group_commit = GroupCommit(self, window, max_writes)
+
+    def stop_group_commits(self):
+        """Stop the groups started with group_commits, after committing the writes waiting to be."""
+        group_commit, self.group_commit = self.group_commit, None
+        if group_commit is not None:
+            group_commit.close()
+
+    def changes_since(self, table, seq, func=None, ids_only=False):
+        """Returns a (seq, rows, deleted) tuple with the changes to [table] after the changelog sequence seq.
+        The returned seq is the latest sequence, to pass the next time.
+        rows is a list with the rows that were added or updated (func is called with each, like select),
+        and deleted is a list with the ids of the rows that were deleted.
+        If seq is 0 or older than what the compacted changelog remembers, rows has all the rows of the table
+        and deleted is None, meaning everything previously received should be replaced.
+        If ids_only is True, rows has the ids of the added or updated rows instead, and no rows are read
+        (it is None when everything should be replaced), so the latest seq can be had cheaply by passing 0.
+        All the queries are made in one read transaction, so they see the DB at the same moment."""
         self.open()
-        self.cursor.execute(query, values)
-        self.commit()
-        self.close()
+        try:
+            if self.hot is None:    # The hot copy is locked while open, so it does not change meanwhile anyway.
+                self.conn.isolation_level = None    # So the sqlite3 module leaves the transaction to us.
+                self.cursor.execute("BEGIN;")
+            try:
+                latest = self.cursor.execute("SELECT IFNULL(MAX(seq), 0) FROM Changelog;").fetchone()[0]
+                horizon = self.cursor.execute("SELECT IFNULL(MAX(seq), 0) FROM ChangelogHorizon;").fetchone()[0]
+                columns = "id" if ids_only else "*"
+                if seq <= 0 or seq < horizon:
+                    rows = None if ids_only else self._fetch(self.cursor.execute("SELECT * FROM {};".format(table)))
+                    deleted = None
+                else:
+                    changed = "SELECT DISTINCT row_id FROM Changelog WHERE tbl = ? AND seq > ? AND seq <= ?"
+                    query = "SELECT {0}.{1} FROM {0} JOIN ({2}) AS c ON {0}.id = c.row_id;"
+                    rows = self._fetch(self.cursor.execute(query.format(table, columns, changed),
+                                                           (table, seq, latest)))
+                    if ids_only:
+                        rows = [row[0] for row in rows]
+                    present = set(row if ids_only else row[0] for row in rows)
+                    deleted = [row[0] for row in self.cursor.execute(changed + ";", (table, seq, latest))
+                               if row[0] not in present]
+            finally:
+                if self.hot is None:
+                    self.cursor.execute("COMMIT;")
+        except sqlite3.Error as e:
+            self._check_timeout(e)
+            raise
+        finally:
+            self.close()
+        if func is not None and not ids_only and rows is not None:
+            rows = [func(row) for row in rows]
+        return latest, rows, deleted
+
+    def last_change(self, table):
+        """Returns the changelog sequence of the latest change to [table], by anyone writing the DB file.
+        It only grows, and grows with every change (once compacted away, the horizon stands in for it)."""
+        self.open()
+        try:
+            return self.cursor.execute("SELECT MAX(IFNULL((SELECT MAX(seq) FROM Changelog WHERE tbl = ?), 0), "
+                                       "IFNULL((SELECT MAX(seq) FROM ChangelogHorizon), 0));", (table, )).fetchone()[0]
+        except sqlite3.Error as e:
+            self._check_timeout(e)
+            raise
+        finally:
+            self.close()
+
+    def compact_changelog(self, limit=None):
+        """Compacts the changelog. Only the latest entry of every row is kept, since changes_since does not need
+        the older ones, and if more than limit (default is ORM.changelog_limit) entries are left,
+        the oldest are removed too. Clients asking for changes older than that will get the full table."""
+        if limit is None:
+            limit = self.changelog_limit
+        self.open()
+        try:
+            self.cursor.execute("DELETE FROM Changelog WHERE seq NOT IN "
+                                "(SELECT MAX(seq) FROM Changelog GROUP BY tbl, row_id);")
+            count = self.cursor.execute("SELECT COUNT(*) FROM Changelog;").fetchone()[0]
+            if count > limit:
+                horizon = self.cursor.execute("SELECT seq FROM Changelog ORDER BY seq LIMIT 1 OFFSET ?;",
+                                              (count - limit, )).fetchone()[0]
+                self.cursor.execute("DELETE FROM Changelog WHERE seq < ?;", (horizon, ))
+                self.cursor.execute("DELETE FROM ChangelogHorizon;")
+                self.cursor.execute("INSERT INTO ChangelogHorizon (seq) VALUES (?);", (horizon - 1, ))
+            self.commit()
+        finally:
+            self.close()
+
+    def add_listener(self, listener, wants_rows=None):
+        """listener is called as listener(action, table, rows) after every successful add, add_many, update and
+        delete, where action is ORM.added, ORM.updated or ORM.deleted,
+        and rows is a list with the changed rows as tuples (after the change, or before it for deletes).
+        The rows are read from the DB for the listeners, which costs a query for every write.
+        If wants_rows is given, it is called with the table before a write, and if it returns False
+        (like when nobody listens to the table now), the rows are not read for this listener,
+        and it is only called if another listener needed them."""
+        self._listeners.append((listener, wants_rows))
+
+    def remove_listener(self, listener):
+        """Stop calling a listener added with add_listener."""
+        self._listeners = [(other, wants_rows) for other, wants_rows in self._listeners if other != listener]
+
+    def _notify(self, action, table, rows):
+        """Calls all the listeners about the changed rows."""
+        if rows:
+            for listener, _ in list(self._listeners):
+                listener(action, table, rows)
+
+    def _wants_rows(self, table):
+        """Returns whether a listener needs the changed rows of a write to [table]."""
+        return any(wants_rows is None or wants_rows(table) for _, wants_rows in list(self._listeners))
+
+    def _rows(self, table, column, value):
+        """Returns the rows of [table] where column = value, but only if there is a listener that needs them."""
+        if not self._wants_rows(table):
+            return []
+        return self.select("SELECT * FROM {} WHERE {} = ?;".format(table, column), tuple, (value, ))
 
     def get(self, table, func=None, ratio="=", **constraints):
         """Return a list with all the [table] where all constraints[0] = constraints[1].
@@ -463,11 +899,12 @@ class ORM(object):
             values = vars(obj)
         columns_tuple, values_tuple = ORM.constraints_to_tuples(**values)
         try:
-            self.change("INSERT INTO {} ".format(table) +
-                        ("(" + ("{}, " * len(columns_tuple))[:-2] + ")").format(*columns_tuple) +
-                        "VALUES (" + ("?, " * len(values_tuple))[:-2] + ");", values_tuple)
+            row_id = self.change("INSERT INTO {} ".format(table) +
+                                 ("(" + ("{}, " * len(columns_tuple))[:-2] + ")").format(*columns_tuple) +
+                                 "VALUES (" + ("?, " * len(values_tuple))[:-2] + ");", values_tuple)
         except sqlite3.Error:
             return False
+        self._notify(ORM.added, table, self._rows(table, "rowid", row_id))
         return True
 
     def update(self, table, (id_column, id_value), obj=None, **updates):
@@ -488,17 +925,105 @@ class ORM(object):
             self.change(query.format(*columns_tuple), values_tuple)
         except sqlite3.Error:
             return False
+        self._notify(ORM.updated, table, self._rows(table, id_column, id_value))
         return True
 
     def delete(self, table, (id_column, id_value)):
         """Deletes the row from [table] WHERE id_column=id_value.
         Returns True for success and False for failure to delete from the DB."""
+        rows = self._rows(table, id_column, id_value)
         try:
             self.change("DELETE FROM {} WHERE {}=?".format(table, id_column), (id_value, ))
         except sqlite3.Error:
             return False
+        self._notify(ORM.deleted, table, rows)
+        return True
+
+    def add_many(self, table, columns, rows, allocator=None):
+        """Inserts all the rows into [table] with executemany, in a single transaction.
+        columns is a sequence of column names, and every row is a sequence of values in the same order.
+        If allocator (an ID object, see id_allocator) is given, a block of ids is reserved from it and
+        an id column is added to every row, so no row depends on SQLite assigning its rowid.
+        The allocator is first moved past the biggest id in [table], for rows added without it since.
+        Returns True for success and False for failure to update the DB (nothing is inserted on failure)."""
+        rows = list(rows)
+        if not rows:
+            return True
+        columns = tuple(columns)
+        if allocator is not None:
+            columns = ("id", ) + columns
+        query = "INSERT INTO {} ".format(table) + ("(" + ("{}, " * len(columns))[:-2] + ")").format(*columns) + \
+                "VALUES (" + ("?, " * len(columns))[:-2] + ");"
+        self.open()
+        try:
+            biggest = self.cursor.execute("SELECT IFNULL(MAX(rowid), 0) FROM {};".format(table)).fetchone()[0]
+            if allocator is not None:
+                allocator.skip_to(biggest + 1)
+                rows = [(row_id, ) + tuple(row) for row_id, row in zip(allocator.reserve(len(rows)), rows)]
+            self.cursor.executemany(query, rows)
+            if allocator is not None:
+                self.cursor.execute("INSERT OR REPLACE INTO IDs (name, next) VALUES (?, ?);",
+                                    (table, allocator.next_id))
+            added = []
+            if self._wants_rows(table):
+                added = self.cursor.execute("SELECT * FROM {} WHERE rowid > ?;".format(table), (biggest, )).fetchall()
+            self.commit()
+        except sqlite3.Error:
+            self.rollback()
+            return False
+        finally:
+            self.close()
+        self._notify(ORM.added, table, added)
         return True
 
+    def id_allocator(self, table):
+        """Returns the ID object that hands out primary keys for [table].
+        The same object is returned for every call, so all threads using this ORM share it.
+        It starts after both the biggest id in [table] and the high-water mark saved with save_ids."""
+        with self._allocators_lock:
+            if table not in self._allocators:
+                biggest = self.select("SELECT MAX(id) FROM {};".format(table), lambda row: row[0])[0]
+                saved = self.select("SELECT next FROM IDs WHERE name = ?;", lambda row: row[0], (table, ))
+                start = max([(biggest or 0) + 1] + saved)
+                self._allocators[table] = ID(start)
+            return self._allocators[table]
+
+    def save_ids(self):
+        """Saves the high-water marks of all the ID objects returned by id_allocator to the DB."""
+        with self._allocators_lock:
+            marks = [(table, allocator.next_id) for table, allocator in self._allocators.iteritems()]
+        self.open()
+        try:
+            self.cursor.executemany("INSERT OR REPLACE INTO IDs (name, next) VALUES (?, ?);", marks)
+            self.commit()
+        finally:
+            self.close()
+
+
+class RosterORM(object):
+    """SQL commands to use with the Roster table (see ORM._start_roster).
+    Its objects are (Player, Team) tuples."""
+    def __init__(self, orm):
+        """Will use the ORM object provided to execute the SQL commands."""
+        self.orm = orm
+
+    @staticmethod
+    def sql_to_object(sql):
+        """sql is the list of values returned from the db.
+        Will return a (Player, Team) tuple, with None for the Team of a player without one."""
+        if sql[8] is None:
+            return Player(*sql[:8]), None
+        return Player(*sql[:8]), Team(sql[7], *sql[8:])
+
+    def get_roster(self, ratio="=", **constraints):
+        """See ORM.get help. The constraints can be on the columns of Players, and on team_name and
+        the other columns of Teams."""
+        return self.orm.get("Roster", RosterORM.sql_to_object, ratio, **constraints)
+
+    def get_roster_contains(self, **constraints):
+        """See ORM.get_contains help."""
+        return self.orm.get_contains("Roster", RosterORM.sql_to_object, **constraints)
+
 
 class TeamORM(object):
     """SQL commands to use with Team class."""
@@ -550,6 +1075,10 @@ class TeamORM(object):
         """When self.get_teams is called with no parameters, this function is called."""
         return self.orm.get("Teams", TeamORM.sql_to_object)
 
+    def get_teams_changes(self, seq, ids_only=False):
+        """Returns the teams that changed after the changelog sequence seq. See ORM.changes_since help."""
+        return self.orm.changes_since("Teams", seq, TeamORM.sql_to_object, ids_only)
+
     # WRITE
 
     def add_team(self, team):
@@ -620,6 +1149,10 @@ class PlayerORM(object):
         """When self.get_players is called with no parameters, this function is called."""
         return self.orm.get("Players", PlayerORM.sql_to_object)
 
+    def get_players_changes(self, seq, ids_only=False):
+        """See TeamORM.get_teams_changes help."""
+        return self.orm.changes_since("Players", seq, PlayerORM.sql_to_object, ids_only)
+
     # WRITE
 
     def add_player(self, player):
@@ -0,0 +1,191 @@
+"""Online backup of an ORM DB into a compressed snapshot, and restoring a DB from one.
+The DB is copied in small steps, each in its own short read, so a server using it keeps answering
+between the steps. Rows changed while the copy runs are copied again from the changelog at the end,
+so the snapshot is the DB as it was at one moment.
+
+Usage:
+    python backup.py create <db name> <snapshot> [--step-rows 500] [--pause 0.005]
+    python backup.py restore <snapshot> <db name>
+The db name excludes .db, like SQL_ORM.ORM's."""
+import argparse
+import gzip
+import os
+import shutil
+import sqlite3
+import sys
+import time
+import SQL_ORM
+
+
+TABLES = ("Teams", "Players")   # Tables with a changelog, copied in steps.
+
+
+class BackupError(Exception):
+    """An exception to show a backup could not be made."""
+    pass
+
+
+def create(db_name, snapshot, step_rows=500, pause=0.005, retries=3):
+    """Copies the DB db_name (excluding .db) to the gzip compressed file snapshot, while it is in use.
+    step_rows rows are copied in every step, with pause seconds between steps for the writers of the DB.
+    If the changelog was compacted past the start of the copy while it ran, the copy is started again,
+    up to retries times before BackupError is raised.
+    Returns the changelog sequence the snapshot is up to date with."""
+    work = snapshot + ".db"
+    for _ in xrange(retries):
+        if os.path.exists(work):
+            os.remove(work)
+        SQL_ORM.ORM(os.path.splitext(work)[0])     # Creates the schema.
+        source = sqlite3.connect(db_name + ".db", isolation_level=None)
+        target = sqlite3.connect(work)
+        try:
+            seq = _copy(source, target, step_rows, pause)
+            if seq is None:
+                continue    # The changelog was compacted too far, start again.
+            target.execute("DELETE FROM Changelog;")   # Filled by the triggers while copying.
+            target.execute("DELETE FROM sqlite_sequence WHERE name = 'Changelog';")
+            target.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('Changelog', ?);", (seq, ))
+            target.commit()
+            target.execute("VACUUM;")
+        finally:
+            source.close()
+            target.close()
+        with open(work, "rb") as f_in:
+            f_out = gzip.open(snapshot + ".tmp", "wb")
+            try:
+                shutil.copyfileobj(f_in, f_out)
+            finally:
+                f_out.close()
+        os.rename(snapshot + ".tmp", snapshot)
+        os.remove(work)
+        return seq
+    if os.path.exists(work):
+        os.remove(work)
+    raise BackupError("The changelog was compacted during every one of %d tries." % retries)
+
+
+def restore(snapshot, db_name):
+    """Replaces the DB db_name (excluding .db) with the one in snapshot (made by create).
+    Must be called before the DB is opened, like when a server starts. The replaced DB is kept as db_name.db.old.
+    The changelog sequences of the restored DB continue after the ones of the replaced DB,
+    so clients that asked it for changes get their tables again in full."""
+    path = db_name + ".db"
+    restored = path + ".restore"
+    f_in = gzip.open(snapshot, "rb")
+    try:
+        with open(restored, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    finally:
+        f_in.close()
+    conn = sqlite3.connect(restored)
+    try:
+        seq = conn.execute("SELECT IFNULL(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'Changelog';").fetchone()[0]
+        if os.path.exists(path):
+            old = sqlite3.connect(path)
+            try:
+                seq = max(seq, old.execute("SELECT IFNULL(MAX(seq), 0) FROM sqlite_sequence "
+                                           "WHERE name = 'Changelog';").fetchone()[0])
+            except sqlite3.Error:
+                pass    # Not an ORM DB.
+            finally:
+                old.close()
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = 'Changelog';")
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('Changelog', ?);", (seq + 1, ))
+        conn.execute("DELETE FROM ChangelogHorizon;")
+        conn.execute("INSERT INTO ChangelogHorizon (seq) VALUES (?);", (seq + 1, ))
+        conn.commit()
+    finally:
+        conn.close()
+    if os.path.exists(path):
+        os.rename(path, path + ".old")
+    os.rename(restored, path)
+
+
+def _copy(source, target, step_rows, pause):
+    """Copies the rows of source to target in steps, then copies the rows that changed meanwhile again.
+    Returns the changelog sequence the copy is up to date with, or None if the changelog was compacted
+    past the start of the copy (so the changed rows are not known)."""
+    start = _latest(source)
+    for table in TABLES:
+        last = 0
+        while True:
+            rows = source.execute("SELECT rowid, * FROM {} WHERE rowid > ? ORDER BY rowid LIMIT ?;".format(table),
+                                  (last, step_rows)).fetchall()
+            if not rows:
+                break
+            marks = ", ".join("?" * (len(rows[0]) - 1))
+            target.executemany("INSERT OR REPLACE INTO {} VALUES ({});".format(table, marks), [row[1:] for row in rows])
+            target.commit()
+            last = rows[-1][0]
+            time.sleep(pause)
+    seq = start
+    while True:     # Catch up in steps, until little is left for the final read.
+        latest = _latest(source)
+        if latest - seq <= step_rows:
+            break
+        seq = _catch_up(source, target, seq, seq + step_rows)
+        if seq is None:
+            return None
+        time.sleep(pause)
+    source.execute("BEGIN;")    # The last changes and the IDs are read in one transaction, to be consistent.
+    try:
+        seq = _catch_up(source, target, seq, _latest(source))
+        if seq is not None:
+            target.execute("DELETE FROM IDs;")
+            target.executemany("INSERT INTO IDs VALUES (?, ?);", source.execute("SELECT * FROM IDs;").fetchall())
+            target.commit()
+    finally:
+        source.execute("COMMIT;")
+    return seq
+
+
+def _catch_up(source, target, seq, until):
+    """Copies the rows changed after the changelog sequence seq and up to until again.
+    Returns until, or None if the changelog was compacted past seq."""
+    horizon = source.execute("SELECT IFNULL(MAX(seq), 0) FROM ChangelogHorizon;").fetchone()[0]
+    if seq < horizon:
+        return None
+    changed = source.execute("SELECT DISTINCT tbl, row_id FROM Changelog WHERE seq > ? AND seq <= ?;",
+                             (seq, until)).fetchall()
+    for table, row_id in changed:
+        if table not in TABLES:
+            continue
+        target.execute("DELETE FROM {} WHERE id = ?;".format(table), (row_id, ))
+        row = source.execute("SELECT * FROM {} WHERE id = ?;".format(table), (row_id, )).fetchone()
+        if row is not None:
+            target.execute("INSERT INTO {} VALUES ({});".format(table, ", ".join("?" * len(row))), row)
+    target.commit()
+    return until
+
+
+def _latest(source):
+    """Returns the latest changelog sequence of source."""
+    return source.execute("SELECT IFNULL(MAX(seq), 0) FROM Changelog;").fetchone()[0]
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+    create_parser = subparsers.add_parser("create", help="Make a snapshot of a DB, even while it is in use.")
+    create_parser.add_argument("db")
+    create_parser.add_argument("snapshot")
+    create_parser.add_argument("--step-rows", type=int, default=500, help="Rows copied in every step.")
+    create_parser.add_argument("--pause", type=float, default=0.005, help="Seconds between steps.")
+    restore_parser = subparsers.add_parser("restore", help="Replace a DB that is not in use with a snapshot.")
+    restore_parser.add_argument("snapshot")
+    restore_parser.add_argument("db")
+    args = parser.parse_args(argv)
+    if args.command == "create":
+        try:
+            seq = create(args.db, args.snapshot, args.step_rows, args.pause)
+        except BackupError as e:
+            sys.exit("ERROR: %s" % e)
+        sys.stderr.write("Snapshot of %s.db at changelog sequence %d written to %s.\n" % (args.db, seq, args.snapshot))
+    else:
+        restore(args.snapshot, args.db)
+        sys.stderr.write("%s.db restored from %s.\n" % (args.db, args.snapshot))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+"""Benchmarks for the server and the ORM. Run them from the repository's directory, like:
+python -m benchmarks.load --help"""
@@ -0,0 +1,240 @@
+"""Load generation for SQLServer.
+Starts a SQLServer on a temporary DB seeded with synthetic teams and players, drives it with
+concurrent SQLClient workers running a configurable mix of requests, and prints (or saves) a JSON report
+with the requests per second and latency percentiles of every kind of request."""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from protocol import SQLServer, SQLClient
+from metrics import percentile
+
+
+DIVISIONS = ("Pacific", "Southwest", "Northwest", "Atlantic", "Central", "Southeast")
+NATIONALITIES = ("USA", "Canada", "France", "Spain", "Serbia", "Greece", "Australia", "Germany")
+NAMES = ("Michael", "Kobe", "LeBron", "Tim", "Kevin", "Stephen", "Dirk", "Tony", "Pau", "Luka")
+
+DEFAULT_MIX = {"get_all": 10, "get_filtered": 40, "contains": 20, "add": 10, "update": 15, "delete": 5}
+
+
+class Workload(object):
+    """The requests a worker can make. Every operation takes a connected SQLClient and returns
+    whether the server answered without an error."""
+    def __init__(self, teams, players):
+        """teams and players are the number of rows the DB was seeded with."""
+        self.teams = teams
+        self._players = players     # Used as the id of the next player to add.
+        self._lock = threading.Lock()
+        self.operations = {"get_all": self.get_all, "get_filtered": self.get_filtered, "contains": self.contains,
+                           "add": self.add, "update": self.update, "delete": self.delete}
+
+    def _player_id(self):
+        """Returns the id of a random player that was added (it may be deleted already)."""
+        return random.randint(1, self._players)
+
+    def get_all(self, client):
+        """Get the whole Players table."""
+        client.receive("Players")
+        return True
+
+    def get_filtered(self, client):
+        """Get the players of a team with an age filter, like the HTML client does."""
+        client.receive("Players", SQLClient.bigger, age=random.randint(18, 40), team_id=random.randint(1, self.teams))
+        return True
+
+    def contains(self, client):
+        """Search the players by part of their first name."""
+        client.receive("Players", first_name=random.choice(NAMES)[:3])
+        return True
+
+    def add(self, client):
+        """Add a player."""
+        with self._lock:
+            self._players += 1
+        return client.add("Players", **_player(random.randint(1, self.teams)))
+
+    def update(self, client):
+        """Update the age of a player."""
+        client.update("Players", self._player_id(), age=random.randint(18, 40))
+        return True     # Updating a deleted player is not an error of the server.
+
+    def delete(self, client):
+        """Delete a player."""
+        client.delete("Players", self._player_id())
+        return True     # Deleting a deleted player is not an error of the server.
+
+
+class Recorder(object):
+    """Collects the latencies of the requests of all the workers. Thread safe."""
+    def __init__(self):
+        """Create an empty Recorder."""
+        self._latencies = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, latency, ok=True):
+        """Add the latency (in seconds) of one request."""
+        with self._lock:
+            self._latencies.setdefault(name, []).append(latency)
+            if not ok:
+                self._errors[name] = self._errors.get(name, 0) + 1
+
+    def report(self, duration):
+        """Returns the report dict of the requests recorded during duration seconds. Latencies are in milliseconds."""
+        with self._lock:
+            verbs = {}
+            total = 0
+            for name, latencies in self._latencies.iteritems():
+                latencies = sorted(latencies)
+                total += len(latencies)
+                verbs[name] = {"requests": len(latencies), "errors": self._errors.get(name, 0),
+                               "requests_per_second": len(latencies) / duration,
+                               "mean_ms": sum(latencies) / len(latencies) * 1000, "max_ms": latencies[-1] * 1000,
+                               "p50_ms": percentile(latencies, 50) * 1000,
+                               "p95_ms": percentile(latencies, 95) * 1000,
+                               "p99_ms": percentile(latencies, 99) * 1000}
+        return {"duration": duration, "requests": total, "requests_per_second": total / duration, "verbs": verbs}
+
+
+def seed(orm, teams, players):
+    """Fill the DB of orm (an SQL_ORM.ORM) with teams synthetic teams and players synthetic players
+    (spread between the teams)."""
+    orm.add_many("Teams", ("name", "state", "city", "division", "arena", "championships", "website"),
+                 (("Team %d" % i, "State %d" % i, "City %d" % i, DIVISIONS[i % len(DIVISIONS)], "Arena %d" % i,
+                   i % 20, "http://team%d.example.com" % i) for i in xrange(1, teams + 1)),
+                 orm.id_allocator("Teams"))
+    columns = ("first_name", "last_name", "number", "age", "rings", "nationality", "team_id")
+    orm.add_many("Players", columns, (tuple(_player(i % teams + 1)[column] for column in columns)
+                                      for i in xrange(players)), orm.id_allocator("Players"))
+
+
+def run(clients=8, duration=10.0, requests=None, teams=30, players=1000, mix=None, address=None,
+        compression=None):
+    """Run the benchmark and return the report dict.
+    clients is the number of concurrent workers, each with its own connection.
+    The workers stop after duration seconds, or after requests requests each if it is given.
+    mix maps the names of Workload operations to their relative weights (DEFAULT_MIX if omitted).
+    A server on a temporary DB is started, unless address (of a running server) is given,
+    then it must be seeded already with at least teams teams and players players.
+    compression is passed to every SQLClient."""
+    mix = DEFAULT_MIX if mix is None else mix
+    for name in mix:
+        if name not in DEFAULT_MIX:
+            raise ValueError("Unknown operation '%s'." % name)
+    temp_dir = None
+    if address is None:
+        temp_dir = tempfile.mkdtemp(prefix="sql_bench_")
+        address = os.path.join(temp_dir, "bench.sock")
+        server = SQLServer((None, None), os.path.join(temp_dir, "bench"), path=address)
+        seed(server.orm, teams, players)
+        thread = threading.Thread(target=server.listen, kwargs={"verbose": False, "verify_join": False})
+        thread.daemon = True
+        thread.start()
+        _wait_for(address)
+    try:
+        workload = Workload(teams, players)
+        names = [name for name, weight in mix.iteritems() for _ in xrange(weight)]
+        recorder = Recorder()
+        deadline = time.time() + duration
+        workers = [threading.Thread(target=_worker, args=(address, compression, workload, names, recorder,
+                                                          deadline, requests)) for _ in xrange(clients)]
+        start = time.time()
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        report = recorder.report(time.time() - start)
+    finally:
+        if temp_dir is not None:
+            server.stop_listening()
+            thread.join()   # Before its socket and DB are removed.
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    report["config"] = {"clients": clients, "duration": duration, "requests": requests, "teams": teams,
+                        "players": players, "mix": mix, "compression": compression}
+    return report
+
+
+def _worker(address, compression, workload, names, recorder, deadline, requests):
+    """Make requests with a new connection until the deadline, or until requests requests were made."""
+    client = SQLClient(address, compression=compression)
+    client.connect()
+    made = 0
+    try:
+        while time.time() < deadline and (requests is None or made < requests):
+            name = random.choice(names)
+            start = time.time()
+            try:
+                ok = workload.operations[name](client)
+            except (ValueError, socket.error):
+                ok = False      # The server answered with an error (writes raise socket.error for them).
+            recorder.record(name, time.time() - start, ok)
+            made += 1
+    finally:
+        client.sock.close()
+
+
+def _wait_for(address, timeout=5.0):
+    """Wait until the server listens on the unix domain socket at address."""
+    deadline = time.time() + timeout
+    while not os.path.exists(address):
+        if time.time() > deadline:
+            raise socket.error("The server did not start listening on %s." % address)
+        time.sleep(0.01)
+    time.sleep(0.05)    # The file is created by bind, just before listen.
+
+
+def _player(team_id):
+    """Returns the values of a random player in team_id."""
+    return {"first_name": random.choice(NAMES), "last_name": "Player%d" % random.randint(1, 10 ** 6),
+            "number": random.randint(0, 99), "age": random.randint(18, 40), "rings": random.randint(0, 6),
+            "nationality": random.choice(NATIONALITIES), "team_id": team_id}
+
+
+def _parse_mix(mix):
+    """Parses a mix like 'get_all=1,add=2' into a dict."""
+    try:
+        return dict((name, int(weight)) for name, weight in (item.split("=") for item in mix.split(",")))
+    except ValueError:
+        raise argparse.ArgumentTypeError("The mix must be like 'get_all=1,add=2'.")
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=8, help="Number of concurrent connections.")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run for.")
+    parser.add_argument("--requests", type=int, default=None, help="Stop every worker after this many requests.")
+    parser.add_argument("--teams", type=int, default=30, help="Number of teams to seed.")
+    parser.add_argument("--players", type=int, default=1000, help="Number of players to seed.")
+    parser.add_argument("--mix", type=_parse_mix, default=None,
+                        help="Weights of the operations, like 'get_all=1,get_filtered=4,add=1'. Operations: " +
+                             ", ".join(sorted(DEFAULT_MIX)) + ".")
+    parser.add_argument("--address", default=None,
+                        help="A running, seeded server to use instead, as host:port or a unix socket path.")
+    parser.add_argument("--compression", default=None, help="Comma separated codecs to offer the server.")
+    parser.add_argument("--output", default=None, help="Write the JSON report to this file instead of stdout.")
+    args = parser.parse_args(argv)
+    address = args.address
+    if address is not None and os.path.sep not in address:
+        host, port = address.rsplit(":", 1)
+        address = (host, int(port))
+    compression = None if args.compression is None else tuple(args.compression.split(","))
+    report = run(args.clients, args.duration, args.requests, args.teams, args.players, args.mix, address,
+                 compression)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
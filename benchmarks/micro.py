@@ -0,0 +1,153 @@
+"""Micro-benchmarks of the in-process hot paths: SQL_ORM queries and conversions, pickling responses,
+and receiving frames with Sock.recv_by_size.
+Results are saved as JSON, and can be compared to a saved baseline to find regressions."""
+import argparse
+import cPickle as pickle
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import SQL_ORM
+from sock import Sock
+from benchmarks.load import seed
+
+
+PICKLE_ROWS = (1000, 10000, 100000)
+FRAME_SIZES = (100, 10 * 1024, 1024 * 1024)
+
+PLAYER_ROW = (1, "Michael", "Jordan", 23, 35, 6, "USA", 1)
+TEAM_ROW = (1, "Bulls", "Illinois", "Chicago", "Central", "United Center", 6, "http://www.nba.com/bulls")
+
+
+def benchmarks(orm):
+    """Returns a list of (name, func, number) for every benchmark, where func is called number times in a row.
+    orm is a seeded SQL_ORM.ORM to query."""
+    player = SQL_ORM.PlayerORM.sql_to_object(PLAYER_ROW)
+    team = SQL_ORM.TeamORM.sql_to_object(TEAM_ROW)
+    player_dict = SQL_ORM.PlayerORM.object_to_dict(player)
+    team_dict = SQL_ORM.TeamORM.object_to_dict(team)
+    cases = [("orm_get_all", lambda: orm.player.get_players(), 20),
+             ("orm_get", lambda: orm.player.get_players("=", team_id=3, age=25), 200),
+             ("orm_get_contains", lambda: orm.player.get_players_contains(first_name="Mic"), 50),
+             ("constraints_to_tuples", lambda: SQL_ORM.ORM.constraints_to_tuples(first_name="Michael", age=23,
+                                                                                  team_id=1), 100000),
+             ("player_sql_to_object", lambda: SQL_ORM.PlayerORM.sql_to_object(PLAYER_ROW), 100000),
+             ("team_sql_to_object", lambda: SQL_ORM.TeamORM.sql_to_object(TEAM_ROW), 100000),
+             ("player_object_to_dict", lambda: SQL_ORM.PlayerORM.object_to_dict(player), 100000),
+             ("player_dict_to_object", lambda: SQL_ORM.PlayerORM.dict_to_object(player_dict), 100000),
+             ("team_object_to_dict", lambda: SQL_ORM.TeamORM.object_to_dict(team), 100000),
+             ("team_dict_to_object", lambda: SQL_ORM.TeamORM.dict_to_object(team_dict), 100000)]
+    for rows in PICKLE_ROWS:
+        players = [SQL_ORM.PlayerORM.sql_to_object((i, ) + PLAYER_ROW[1:]) for i in xrange(rows)]
+        pickled = pickle.dumps(players, pickle.HIGHEST_PROTOCOL)
+        number = max(1, 100000 / rows)
+        cases.append(("pickle_dumps_%d" % rows,
+                      lambda players=players: pickle.dumps(players, pickle.HIGHEST_PROTOCOL), number))
+        cases.append(("pickle_loads_%d" % rows, lambda pickled=pickled: pickle.loads(pickled), number))
+    return cases
+
+
+def measure(func, number, repeat=5):
+    """Returns the seconds per call of func, from the fastest of repeat runs of number calls."""
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        for _ in xrange(number):
+            func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / number
+
+
+def measure_recv(size, number, repeat=5):
+    """Returns the seconds per Sock.recv_by_size call for frames of size bytes sent over a socketpair,
+    from the fastest of repeat runs of number frames."""
+    left, right = socket.socketpair()
+    sender, receiver = Sock.copy(left), Sock.copy(right)
+    left.close()
+    right.close()
+    frame = "x" * size
+    best = None
+    try:
+        for _ in xrange(repeat):
+            thread = threading.Thread(target=lambda: [sender.send_by_size(frame) for _ in xrange(number)])
+            thread.start()
+            start = time.time()
+            for _ in xrange(number):
+                receiver.recv_by_size()
+            elapsed = time.time() - start
+            thread.join()
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        sender.close()
+        receiver.close()
+    return best / number
+
+
+def run(repeat=5, name_filter=None):
+    """Run the benchmarks whose names contain name_filter (all if None), and return a dict
+    of name: {"seconds": seconds per call, "number": calls per run}."""
+    temp_dir = tempfile.mkdtemp(prefix="sql_micro_")
+    results = {}
+    try:
+        orm = SQL_ORM.ORM(os.path.join(temp_dir, "micro"))
+        seed(orm, 30, 1000)
+        for name, func, number in benchmarks(orm):
+            if name_filter is None or name_filter in name:
+                results[name] = {"seconds": measure(func, number, repeat), "number": number}
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    for size in FRAME_SIZES:
+        name = "recv_by_size_%d" % size
+        if name_filter is None or name_filter in name:
+            number = max(10, 10 * 1024 * 1024 / size / 10)
+            results[name] = {"seconds": measure_recv(size, number, repeat), "number": number}
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Returns a list of (name, baseline seconds, seconds) for every benchmark in both results and baseline
+    that got slower by more than tolerance (0.2 is 20%)."""
+    regressions = []
+    for name in sorted(results):
+        if name in baseline:
+            old, new = baseline[name]["seconds"], results[name]["seconds"]
+            if new > old * (1 + tolerance):
+                regressions.append((name, old, new))
+    return regressions
+
+
+def main(argv=None):
+    """Command line entry point. Exits with 1 if a regression was found."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output", default=None, help="Write the JSON results to this file instead of stdout.")
+    parser.add_argument("--baseline", default=None, help="Compare the results to this JSON file of saved results.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Slowdown relative to the baseline that counts as a regression (default 0.2).")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of every benchmark, the fastest counts.")
+    parser.add_argument("--filter", default=None, help="Only run benchmarks with this in their name.")
+    args = parser.parse_args(argv)
+    results = run(args.repeat, args.filter)
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, old, new in regressions:
+            sys.stderr.write("REGRESSION %s: %.3gs -> %.3gs (%+.0f%%)\n" % (name, old, new, (new / old - 1) * 100))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
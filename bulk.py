@@ -0,0 +1,161 @@
+"""Bulk import and export of the Players and Teams tables of an ORM DB, as CSV or JSON lines.
+Rows are read, inserted (with executemany, batch_size rows per transaction) and written as a stream,
+so files of any size take constant memory.
+
+Usage:
+    python bulk.py import <Players|Teams> <file> [--db ORM] [--format csv|jsonl] [--batch-size 10000] [--keep-ids]
+    python bulk.py export <Players|Teams> <file> [--db ORM] [--format csv|jsonl]
+Use - as the file for stdin or stdout. The format is guessed from the file's extension if omitted.
+Players' team_id can be the name of the team instead of its id."""
+import argparse
+import csv
+import itertools
+import json
+import sys
+import SQL_ORM
+
+
+COLUMNS = {"Players": ("first_name", "last_name", "number", "age", "rings", "nationality", "team_id"),
+           "Teams": ("name", "state", "city", "division", "arena", "championships", "website")}
+INT_COLUMNS = ("id", "number", "age", "rings", "championships")
+
+
+class BulkError(Exception):
+    """An exception to show rows could not be imported."""
+    pass
+
+
+def import_rows(orm, table, rows, batch_size=10000, keep_ids=False):
+    """Inserts rows (an iterable of dicts with the columns of table) into table, batch_size rows per transaction.
+    Players' team_id values that are not numbers are looked up as team names, with one query for all of them.
+    Unless keep_ids is True, the rows get new ids (an id in a row is ignored).
+    Returns the number of rows inserted. Raises BulkError if a row is not valid or a batch could not be inserted,
+    the batches before it stay inserted."""
+    if table not in COLUMNS:
+        raise BulkError("Unknown table '%s'." % table)
+    columns = COLUMNS[table]
+    team_ids = None
+    if table == "Players":
+        team_ids = dict(orm.select("SELECT name, id FROM Teams;", lambda row: row))
+    allocator = None if keep_ids else orm.id_allocator(table)
+    count = 0
+    rows = iter(rows)
+    while True:
+        batch = [_values(row, table, team_ids, keep_ids, count + i + 1)
+                 for i, row in enumerate(itertools.islice(rows, batch_size))]
+        if not batch:
+            return count
+        if not orm.add_many(table, ("id", ) + columns if keep_ids else columns, batch, allocator):
+            raise BulkError("Could not insert rows %d to %d." % (count + 1, count + len(batch)))
+        count += len(batch)
+
+
+def export_rows(orm, table):
+    """A generator of the rows of table as dicts (with their id), in the order of their ids."""
+    if table not in COLUMNS:
+        raise BulkError("Unknown table '%s'." % table)
+    columns = ("id", ) + COLUMNS[table]
+    query = "SELECT {} FROM {} ORDER BY id;".format(", ".join(columns), table)
+    return orm.stream(query, lambda row: dict(zip(columns, row)))
+
+
+def read_csv(f):
+    """A generator of the rows of a CSV file (with a header line) as dicts of unicode values."""
+    for row in csv.DictReader(f):
+        yield dict((key, value.decode("utf-8")) for key, value in row.iteritems())
+
+
+def read_jsonl(f):
+    """A generator of the rows of a JSON lines file as dicts."""
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+def write_csv(f, table, rows):
+    """Writes the rows (dicts, like export_rows returns) of table to a CSV file, with a header line."""
+    columns = ("id", ) + COLUMNS[table]
+    writer = csv.writer(f)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([row[column].encode("utf-8") if isinstance(row[column], unicode) else row[column]
+                         for column in columns])
+
+
+def write_jsonl(f, table, rows):
+    """Writes the rows (dicts, like export_rows returns) to a JSON lines file."""
+    for row in rows:
+        f.write(json.dumps(row, sort_keys=True) + "\n")
+
+
+def _values(row, table, team_ids, keep_ids, number):
+    """Returns the tuple of values to insert for a row of table, with team names replaced by ids.
+    The row is checked like the server checks the objects it adds (e.g. the division must exist).
+    number is the row's number, for the errors."""
+    columns = ("id", ) + COLUMNS[table] if keep_ids else COLUMNS[table]
+    try:
+        values = []
+        for column in columns:
+            value = row[column]
+            if column == "team_id" and not (isinstance(value, (int, long)) or unicode(value).isdigit()):
+                value = team_ids[value]
+            elif column in INT_COLUMNS or column == "team_id":
+                value = int(value)
+            values.append(value)
+    except KeyError as e:
+        raise BulkError("Row %d: missing column or unknown team %s." % (number, e))
+    except (TypeError, ValueError):
+        raise BulkError("Row %d: %s must be an integer." % (number, column))
+    record = dict(zip(columns, values))
+    record.setdefault("id", None)
+    try:
+        (SQL_ORM.TeamORM if table == "Teams" else SQL_ORM.PlayerORM).dict_to_object(record)
+    except (TypeError, ValueError) as e:
+        raise BulkError("Row %d: %s" % (number, str(e) or "unknown division %s." % record.get("division")))
+    return tuple(values)
+
+
+def _format(path, fmt):
+    """Returns the format to use for path."""
+    if fmt is not None:
+        return fmt
+    return "csv" if path.endswith(".csv") else "jsonl"
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("import", "export"))
+    parser.add_argument("table", choices=sorted(COLUMNS))
+    parser.add_argument("file")
+    parser.add_argument("--db", default="ORM", help="The name of the DB, without .db (default ORM).")
+    parser.add_argument("--format", choices=("csv", "jsonl"), default=None)
+    parser.add_argument("--batch-size", type=int, default=10000, help="Rows per transaction when importing.")
+    parser.add_argument("--keep-ids", action="store_true", help="Import the ids in the file instead of new ones.")
+    args = parser.parse_args(argv)
+    orm = SQL_ORM.ORM(args.db)
+    fmt = _format(args.file, args.format)
+    if args.command == "import":
+        f = sys.stdin if args.file == "-" else open(args.file, "rb" if fmt == "csv" else "r")
+        try:
+            rows = read_csv(f) if fmt == "csv" else read_jsonl(f)
+            count = import_rows(orm, args.table, rows, args.batch_size, args.keep_ids)
+        except BulkError as e:
+            sys.exit("ERROR: %s" % e)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        if not args.keep_ids:
+            orm.save_ids()
+        sys.stderr.write("Imported %d rows into %s.\n" % (count, args.table))
+    else:
+        f = sys.stdout if args.file == "-" else open(args.file, "wb" if fmt == "csv" else "w")
+        try:
+            (write_csv if fmt == "csv" else write_jsonl)(f, args.table, export_rows(orm, args.table))
+        finally:
+            if f is not sys.stdout:
+                f.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import Queue
+import sqlite3
+import threading
+import time
+
+
+class GroupCommit(object):
+    """Gathers the writes that threads make through an SQL_ORM.ORM, and executes them in one transaction,
+    so many concurrent writes wait for one commit (one sync of the disk) instead of one commit each.
+    A background thread starts a transaction with the first write waiting, adds the writes that arrive
+    within window seconds (up to max_writes), commits, and then lets all their threads go on."""
+    def __init__(self, orm, window=0.002, max_writes=100):
+        """orm is the ORM to execute the writes with (its open, commit and close are used).
+        window is the most seconds a write waits for others to join its transaction."""
+        self.orm = orm
+        self.window = window
+        self.max_writes = max_writes
+        self.transactions = 0
+        self.writes = 0
+        self._queue = Queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()   # So no write is queued after close.
+        self._thread = threading.Thread(target=self._commit_writes)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def change(self, query, values=()):
+        """Executes the query in the next transaction and returns (lastrowid, rowcount) once it is committed.
+        Raises the sqlite3.Error of the query, or of the commit, like executing and committing it alone would.
+        The writes of one thread are executed in the order they were made."""
+        write = _Write(query, values)
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._queue.put(write)
+        if closed:
+            self._commit([write])
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.row_id, write.rows
+
+    def close(self, timeout=None):
+        """Execute the writes that are waiting, and stop the background thread.
+        Writes made after it are committed alone."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join(timeout)
+
+    def as_dict(self):
+        """Returns the counters as a dict."""
+        return {"transactions": self.transactions, "writes": self.writes}
+
+    def _commit_writes(self):
+        """The background thread, which commits the writes in groups until close is called."""
+        stop = False
+        while not stop:
+            write = self._queue.get()
+            if write is None:
+                break
+            writes = [write]
+            deadline = time.time() + self.window
+            while len(writes) < self.max_writes:
+                try:
+                    write = self._queue.get(timeout=max(deadline - time.time(), 0))
+                except Queue.Empty:
+                    break
+                if write is None:
+                    stop = True
+                    break
+                writes.append(write)
+            self._commit(writes)
+
+    def _commit(self, writes):
+        """Executes the writes in one transaction and commits it.
+        A write that fails is undone alone (SQLite undoes a failed statement, not its transaction),
+        but if the commit fails, all the writes failed."""
+        self.orm.open()
+        try:
+            for write in writes:
+                try:
+                    self.orm.cursor.execute(write.query, write.values)
+                    write.row_id = self.orm.cursor.lastrowid
+                    write.rows = self.orm.cursor.rowcount
+                except sqlite3.Error as e:
+                    write.error = e
+            self.orm.commit()
+        except sqlite3.Error as e:
+            for write in writes:
+                write.error = write.error or e
+            try:
+                self.orm.rollback()
+            except sqlite3.Error:
+                pass
+        finally:
+            self.orm.close()
+            self.transactions += 1
+            self.writes += len(writes)
+            for write in writes:
+                write.done.set()
+
+
+class _Write(object):
+    """A write waiting for GroupCommit, and its result."""
+    def __init__(self, query, values):
+        self.query = query
+        self.values = values
+        self.row_id = None
+        self.rows = None
+        self.error = None
+        self.done = threading.Event()
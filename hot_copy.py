@@ -0,0 +1,173 @@
+import Queue
+import sqlite3
+import threading
+
+
+class HotCopy(object):
+    """An in-memory copy of an SQLite DB file, that all threads share through one connection.
+    Reads are served from memory, and every committed write is applied to memory and to the file,
+    in the same order, right away or (with async_writes) by a background thread.
+    The connection is locked by the thread using it, so all reads and writes run one at a time.
+    That is still faster than reading the file while queries are short, but long reads hold up everything.
+    The writes are applied to the file as statements, so it must not be written by anyone else meanwhile:
+    the file stays write locked from the load on (other connections can only read it, and fail to write it),
+    and if it was written anyway, the writes to it fail from then on with sqlite3.DatabaseError."""
+
+    # Statements starting with these are not changes, so they are not written to the file.
+    read_only = ("SELECT", "PRAGMA", "EXPLAIN")
+
+    def __init__(self, path, async_writes=False):
+        """Load the DB file at path (which must have its schema already) into memory.
+        If async_writes is True, the writes are applied to the file by a background thread, so they do not wait
+        for the disk, but the last ones are lost if the process dies before flush is called.
+        Writes the file refused then stay in memory only, and are counted in write_errors (see as_dict)."""
+        self.path = path
+        self.async_writes = async_writes
+        self.write_errors = 0
+        self.last_write_error = None
+        self._disk = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._disk.execute("PRAGMA foreign_keys = ON;")
+        self._disk_locked = False
+        self._lock_disk()   # Before loading, so nothing is written between the load and the first write.
+        self._data_version = self._disk.execute("PRAGMA data_version;").fetchone()[0]
+        self._memory = sqlite3.connect(":memory:", check_same_thread=False)
+        self._load()
+        self._memory.execute("PRAGMA foreign_keys = ON;")
+        self._cursor = _RecordingCursor(self._memory.cursor(), self)
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._pending = []
+        self._queue = None
+        if async_writes:
+            self._queue = Queue.Queue()
+            thread = threading.Thread(target=self._write_queued)
+            thread.daemon = True
+            thread.start()
+
+    def _load(self):
+        """Copy the schema and the rows of the file into memory."""
+        self._memory.execute("ATTACH DATABASE ? AS disk;", (self.path, ))
+        schema = self._memory.execute("SELECT type, name, sql FROM disk.sqlite_master "
+                                      "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%';").fetchall()
+        for kind, name, sql in schema:
+            if kind == "table":
+                self._memory.execute(sql)
+                self._memory.execute("INSERT INTO main.{0} SELECT * FROM disk.{0};".format(name))
+        for kind, name, sql in schema:
+            if kind != "table":     # Triggers are created after the rows are in, so they do not run for them.
+                self._memory.execute(sql)
+        if self._memory.execute("SELECT 1 FROM disk.sqlite_master WHERE name = 'sqlite_sequence';").fetchone():
+            self._memory.execute("DELETE FROM main.sqlite_sequence;")     # Filled by the copy of the rows.
+            self._memory.execute("INSERT INTO main.sqlite_sequence SELECT * FROM disk.sqlite_sequence;")
+        self._memory.commit()
+        self._memory.execute("DETACH DATABASE disk;")
+
+    def acquire(self):
+        """Returns (connection, cursor) of the in-memory DB for the calling thread to use alone,
+        until it calls release. Writes made with the cursor are written to the file when committed is called."""
+        self._lock.acquire()
+        self._depth += 1
+        return self._memory, self._cursor
+
+    def release(self):
+        """Give back the connection taken with acquire. Writes that were not committed are forgotten."""
+        self._depth -= 1
+        if self._depth == 0:
+            del self._pending[:]
+        self._lock.release()
+
+    def commit(self):
+        """Commit the connection taken with acquire, and write the changes since the last commit to the file.
+        Without async_writes the file is written first, and if it fails the connection is rolled back
+        and the sqlite3.Error is raised, so memory never has writes the file does not."""
+        statements, self._pending = self._pending, []
+        if statements and self._queue is None:
+            try:
+                self._write(statements)
+            except sqlite3.Error:
+                self._memory.rollback()
+                raise
+        self._memory.commit()
+        if statements and self._queue is not None:
+            self._queue.put(statements)
+
+    def rolled_back(self):
+        """Called after the connection is rolled back, to forget the changes since the last commit."""
+        del self._pending[:]
+
+    def flush(self):
+        """Wait until all the committed writes are written to the file."""
+        if self._queue is not None:
+            self._queue.join()
+
+    def as_dict(self):
+        """Returns the counters as a dict."""
+        return {"write_errors": self.write_errors, "last_write_error": self.last_write_error,
+                "queued_writes": 0 if self._queue is None else self._queue.qsize()}
+
+    def _record(self, many, sql, values):
+        """Keep a statement executed on the in-memory DB, to write it to the file on commit."""
+        if not sql.lstrip().upper().startswith(HotCopy.read_only):
+            self._pending.append((many, sql, values))
+
+    def _write(self, statements):
+        """Apply the statements to the file in one transaction. Raises the sqlite3.Error if it fails,
+        or sqlite3.DatabaseError if the file was written by another connection since it was loaded."""
+        try:
+            self._lock_disk()
+            if self._disk.execute("PRAGMA data_version;").fetchone()[0] != self._data_version:
+                raise sqlite3.DatabaseError("The DB file was written by another connection, "
+                                            "it does not match the hot copy anymore.")
+            for many, sql, values in statements:
+                if many:
+                    self._disk.executemany(sql, values)
+                else:
+                    self._disk.execute(sql, values)
+            self._disk.execute("COMMIT;")
+            self._disk_locked = False
+            self._lock_disk()
+        except sqlite3.Error as e:
+            if self._disk_locked:
+                self._disk.execute("ROLLBACK;")
+                self._disk_locked = False
+            self.write_errors += 1
+            self.last_write_error = str(e)
+            raise
+
+    def _lock_disk(self):
+        """Open a write transaction on the file, if there is none, so other connections cannot write it."""
+        if not self._disk_locked:
+            self._disk.execute("BEGIN IMMEDIATE;")
+            self._disk_locked = True
+
+    def _write_queued(self):
+        """The background thread of async_writes. Its errors are only counted, the writes are committed already."""
+        while True:
+            statements = self._queue.get()
+            try:
+                self._write(statements)
+            except sqlite3.Error:
+                pass
+            finally:
+                self._queue.task_done()
+
+
+class _RecordingCursor(object):
+    """A cursor of the in-memory DB that keeps the changes it executes for HotCopy."""
+    def __init__(self, cursor, hot_copy):
+        self._cursor = cursor
+        self._hot_copy = hot_copy
+
+    def execute(self, sql, values=()):
+        result = self._cursor.execute(sql, values)
+        self._hot_copy._record(False, sql, values)
+        return result
+
+    def executemany(self, sql, values):
+        values = list(values)
+        result = self._cursor.executemany(sql, values)
+        self._hot_copy._record(True, sql, values)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
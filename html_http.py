@@ -0,0 +1,174 @@
+import BaseHTTPServer
+import SocketServer
+import threading
+import urlparse
+import hashlib
+import gzip
+import os
+import sqlite3
+import cStringIO as StringIO
+import html_templates
+
+
+HTML_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "HTML")
+HTML_PLAYERS_PATH = os.path.join(HTML_DIR, "players.html")
+HTML_TEAMS_PATH = os.path.join(HTML_DIR, "teams.html")
+
+INT_FILTERS = ("id", "number", "age", "rings", "championships")
+TABLES = {"/players": "Players", "/teams": "Teams"}
+FILTERS = {"/players": ("id", "first_name", "last_name", "number", "age", "rings", "nationality", "team_id"),
+           "/teams": ("id", "name", "state", "city", "division", "arena", "championships", "website")}
+RATIOS = ("=", "<", ">")
+
+
+class PageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """An HTTP server that serves the players and teams pages of a SQLServer."""
+
+    daemon_threads = True
+
+    def __init__(self, (ip, port), sql_server, verbose=True):
+        """(ip, port) is the ip and port combination to listen on for HTTP,
+        and sql_server is the SQLServer to get the information from."""
+        BaseHTTPServer.HTTPServer.__init__(self, (ip, port), PageRequestHandler)
+        self.sql_server = sql_server
+        self.verbose = verbose
+        self.fragments = {"/players": html_templates.FragmentCache(html_templates.players(HTML_PLAYERS_PATH)),
+                          "/teams": html_templates.FragmentCache(html_templates.teams(HTML_TEAMS_PATH))}
+        self._seqs = {"/players": 0, "/teams": 0}   # The changelog sequence every FragmentCache is up to date with.
+        self._seqs_lock = threading.Lock()
+
+    def fresh_fragments(self, page):
+        """Returns (FragmentCache, generation) of the page, after forgetting the rows that changed since it was
+        last used, by anyone writing the DB (see SQL_ORM.ORM.changes_since). Rows read after it are not older
+        than the cache, pass generation to FragmentCache.write with them.
+        Player rows showing a renamed team are rendered again since their team argument changes."""
+        fragments = self.fragments[page]
+        with self._seqs_lock:
+            seq, changed, deleted = self.sql_server.orm.changes_since(TABLES[page], self._seqs[page], ids_only=True)
+            if deleted is None:
+                fragments.clear()
+            elif changed or deleted:
+                fragments.invalidate(*(changed + deleted))
+            self._seqs[page] = seq
+            return fragments, fragments.generation
+
+
+class PageRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers GET /players and GET /teams with the HTML pages, filtered by the query string,
+    and GET /metrics with the statistics of the server (see SQLServer.prometheus).
+    The query string is like the constraints of SQLClient.receive, with an optional 'ratio'
+    ('team' can be used for 'team_id', with the team's name or id)."""
+
+    def do_GET(self):
+        """Answer a GET request."""
+        url = urlparse.urlparse(self.path)
+        page = url.path.rstrip("/")
+        if page == "/metrics":
+            self._send_metrics()
+            return
+        if page not in ("/players", "/teams"):
+            self.send_error(404, "Only /players, /teams and /metrics exist.")
+            return
+        sql_server = self.server.sql_server
+        query = urlparse.parse_qs(url.query)
+        try:
+            ratio, constraints = _filters(query, FILTERS[page])
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+        # The versions (changelog sequences) are read before the rows, so the ETag is never newer than the page.
+        # The gzipped and plain bodies are different bytes, so they get different ETags.
+        try:
+            versions = sql_server.version("Players") + sql_server.version("Teams")
+            fragments, generation = self.server.fresh_fragments(page)
+        except sqlite3.Error:
+            self.send_error(503, "The DB could not be read.")
+            return
+        etag = '"%s%s"' % (hashlib.md5(page + versions + url.query).hexdigest(), "-gzip" if gzipped else "")
+        if etag in self.headers.get("If-None-Match", ""):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return
+        sql_server.orm.set_deadline(sql_server.query_deadline)
+        try:
+            if page == "/players":
+                objects = sql_server.query("Roster", ratio, constraints)
+                rows = ((player, "" if team is None else team.name) for player, team in objects)
+            else:
+                objects = sql_server.query("Teams", ratio, constraints)
+                rows = ((team, ) for team in objects)
+        finally:
+            sql_server.orm.set_deadline(None)
+        if isinstance(objects, basestring):
+            err = objects.split("~")
+            self.send_error(503 if err[1] == "TIMEOUT" else 400, "%s: %s" % (err[1], err[3]))
+            return
+        body = StringIO.StringIO()
+        if gzipped:
+            with gzip.GzipFile(fileobj=body, mode="wb") as out:
+                fragments.write(out, rows, generation)
+        else:
+            fragments.write(body, rows, generation)
+        body = body.getvalue()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Vary", "Accept-Encoding")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_metrics(self):
+        """Answer with the statistics of the SQLServer in the Prometheus text format."""
+        body = self.server.sql_server.prometheus()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Log requests only if the server is verbose."""
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def start(sql_server, (ip, port), verbose=True):
+    """Start serving the pages of sql_server over HTTP on (ip, port) in a new thread.
+    Returns the PageServer, call its shutdown method to stop."""
+    server = PageServer((ip, port), sql_server, verbose)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _filters(query, columns):
+    """Returns (ratio, constraints) for SQLServer from a parsed query string (ratio and constraints are None
+    if there are no filters). Only the columns given can be filtered by, since they become part of the SQL.
+    Raises ValueError if the filters are not valid."""
+    ratio = query.pop("ratio", ["="])[0]
+    if ratio not in RATIOS:
+        raise ValueError("ratio must be one of %s." % ", ".join(RATIOS))
+    constraints = dict((key, values[0]) for key, values in query.iteritems())
+    if "team" in constraints:
+        constraints["team_id"] = constraints.pop("team")
+    for key in constraints:
+        if key not in columns:
+            raise ValueError("Cannot filter by '%s'." % key)
+    if constraints.get("team_id", "").isdigit():
+        constraints["team_id"] = int(constraints["team_id"])
+    for key in INT_FILTERS:
+        if key in constraints:
+            try:
+                constraints[key] = int(constraints[key])
+            except ValueError:
+                raise ValueError("%s must be an integer." % key)
+    if not constraints:
+        return None, None
+    return ratio, constraints
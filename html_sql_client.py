@@ -1,6 +1,7 @@
 __author__ = 'Omer'
 
 from protocol import SQLClient
+import html_templates
 import socket
 import sys
 import webbrowser
@@ -13,19 +14,21 @@ HTML_PLAYERS_PATH = "HTML/players.html"
 HTML_TEAMS_PATH = "HTML/teams.html"
 HTML_PLAYERS_NEW_PATH = "HTML/new_players.html"
 HTML_TEAMS_NEW_PATH = "HTML/new_teams.html"
-HTML_SPLITTER = "            <tbody>\n"
+HTML_SPLITTER = html_templates.HTML_SPLITTER
 
 
 def main():
     my_interface = Interface(help_user)
     print("Connecting to server. Please wait.")
     try:
-        client = SQLClient((raw_input("Enter IP: "), PORT))
+        address = raw_input("Enter IP (or the path of the server's unix socket): ")
+        client = SQLClient(address if os.path.sep in address else (address, PORT), cache=True)
         client.connect()
     except socket.error:
         raw_input("Could not connect to server. Press Enter to exit.")
         sys.exit(0)
     print("Connected")
+    my_interface.get_request = lambda: _connected(client, Interface.default_get())
     my_interface.answer("help")
     get_ui, add_ui, update_ui, delete_ui = generate_interfaces(client)
     my_interface.add_request("test", test_server, client)
@@ -37,6 +40,15 @@ def main():
     loop_interface(my_interface)
 
 
+def _connected(client, request):
+    """Connects the client again if the server closed the connection while the user was away
+    (the server disconnects idle clients), and returns request."""
+    if client.sock.peer_closed():
+        print("Reconnecting to server.")
+        client.reconnect()
+    return request
+
+
 def loop_interface(ui):
     """Loops the interface ignoring errors."""
     try:
@@ -110,7 +122,8 @@ def get_players(client):
         return
     real_path = os.path.realpath(HTML_PLAYERS_PATH)
     real_new_path = os.path.realpath(HTML_PLAYERS_NEW_PATH)
-    make_html_players(client.receive("Players", **values), client, real_path, real_new_path)
+    fragments = _fragments(client, "Players", html_templates.players(real_path))   # Before the rows are read.
+    make_html_roster(client.receive("Roster", **values), real_path, real_new_path, fragments)
     webbrowser.open_new_tab("file://" + real_new_path)
     raw_input("Please press Enter to continue.")
     remove_file(real_new_path)
@@ -130,50 +143,68 @@ def get_teams(client):
         return
     real_path = os.path.realpath(HTML_TEAMS_PATH)
     real_new_path = os.path.realpath(HTML_TEAMS_NEW_PATH)
-    make_html_teams(client.receive("Teams", **values), real_path, real_new_path)
+    fragments = _fragments(client, "Teams", html_templates.teams(real_path))   # Before the rows are read.
+    make_html_teams(client.receive("Teams", **values), real_path, real_new_path, fragments)
     webbrowser.open_new_tab("file://" + real_new_path)
     raw_input("Please press Enter to continue.")
     remove_file(real_new_path)
 
 
-def make_html_players(players, client, read_path=HTML_PLAYERS_PATH, write_path=HTML_PLAYERS_NEW_PATH):
+def make_html_players(players, client, read_path=HTML_PLAYERS_PATH, write_path=HTML_PLAYERS_NEW_PATH,
+                      fragments=None):
     """Constructs an HTML file with the given players.
-    :returns the file test as before changed."""
-    with open(read_path, "r") as f:
-        opening, ending = f.read().split(HTML_SPLITTER)
-    players_string = ""
-    for player in players:
-        team = html_get_team(player, client)
-        players_string += "                <tr id = '{} {}'>\n".format(player.first_name, player.last_name)
-        players_string += "                    <td>{}</td>\n".format(player.first_name)
-        players_string += "                    <td>{}</td>\n".format(player.last_name)
-        players_string += "                    <td>{}</td>\n".format(team)
-        players_string += "                    <td>{}</td>\n".format(str(player.number))
-        players_string += "                    <td>{}</td>\n".format(str(player.age))
-        players_string += "                    <td>{}</td>\n".format(str(player.rings))
-        players_string += "                    <td>{}</td>\n".format(player.nationality)
-        players_string += "                </tr>\n"
-    with open(write_path, "w") as f:
-        f.write(opening + HTML_SPLITTER + players_string + ending)
-
-
-def make_html_teams(teams, read_path=HTML_TEAMS_PATH, write_path=HTML_TEAMS_NEW_PATH):
-    with open(read_path, "r") as f:
-        opening, ending = f.read().split(HTML_SPLITTER)
-    teams_string = ""
-    for team in teams:
-        teams_string += "                <tr id = '{}'>\n".format(team.name)
-        teams_string += "                    <td>{}</td>\n".format(team.name)
-        teams_string += "                    <td>{}</td>\n".format(team.state)
-        teams_string += "                    <td>{}</td>\n".format(team.city)
-        teams_string += "                    <td>{}</td>\n".format(team.division.conference)
-        teams_string += "                    <td>{}</td>\n".format(team.division.division)
-        teams_string += "                    <td>{}</td>\n".format(team.arena)
-        teams_string += "                    <td>{}</td>\n".format(str(team.championships))
-        teams_string += "                    <td><a href = '{0}' target = '_blank'>{0}</a></td>\n".format(team.website)
-        teams_string += "                </tr>\n"
-    with open(write_path, "w") as f:
-        f.write(opening + HTML_SPLITTER + teams_string + ending)
+    players can be any iterable, and each row is written as soon as its player is reached.
+    write_path can also be an object with a write method to write the page to.
+    If fragments (an html_templates.FragmentCache of the template) is given, rows are taken from it when kept."""
+    template = fragments or html_templates.players(read_path)
+    _write_page(template, ((player, html_get_team(player, client)) for player in players), write_path)
+
+
+def make_html_roster(roster, read_path=HTML_PLAYERS_PATH, write_path=HTML_PLAYERS_NEW_PATH, fragments=None):
+    """Constructs an HTML file with the players of roster, a list of (player, team) tuples like
+    the Roster table is received in (team is None for players without one), so no request is needed for the teams.
+    See make_html_players help."""
+    template = fragments or html_templates.players(read_path)
+    _write_page(template, ((player, "" if team is None else team.name) for player, team in roster), write_path)
+
+
+def make_html_teams(teams, read_path=HTML_TEAMS_PATH, write_path=HTML_TEAMS_NEW_PATH, fragments=None):
+    """Constructs an HTML file with the given teams. See make_html_players help."""
+    template = fragments or html_templates.teams(read_path)
+    _write_page(template, ((team, ) for team in teams), write_path)
+
+
+_fragment_caches = {}   # table: [FragmentCache, the changelog sequence it is up to date with]
+
+
+def _fragments(client, table, template):
+    """Returns the FragmentCache for the rows of the table,
+    after forgetting the rows that were added, updated or deleted on the server since it was last used.
+    Only the ids of the changed rows are asked for, so the first call just gets the current sequence.
+    Call it before receiving the rows to write with it, so no row older than the sequence is kept."""
+    if table not in _fragment_caches:
+        _fragment_caches[table] = [html_templates.FragmentCache(template), 0]
+    fragments, seq = _fragment_caches[table]
+    try:
+        seq, changed, deleted = client.changes(table, seq, ids_only=True)
+    except (socket.error, ValueError):
+        fragments.clear()
+        return fragments
+    if deleted is None:
+        fragments.clear()
+    else:
+        fragments.invalidate(*(changed + deleted))
+    _fragment_caches[table][1] = seq
+    return fragments
+
+
+def _write_page(template, rows, write_path):
+    """Writes the template (or FragmentCache) with the rows to write_path (a path or an object with a write method)."""
+    if hasattr(write_path, "write"):
+        template.write(write_path, rows)
+    else:
+        with open(write_path, "w") as f:
+            template.write(f, rows)
 
 
 def html_get_team(player, client):
@@ -2,16 +2,18 @@ __author__ = 'Omer'
 
 from protocol import SQLServer
 import sys
-    
 
-def main(db_name="ORM"):
-    server = SQLServer(("0.0.0.0", 53326), db_name)
+
+IDLE_TIMEOUT = 600  # Seconds a client may not send requests for before it is disconnected.
+
+
+def main(db_name="ORM", unix_path=None, http_port=None, restore_from=None):
+    http_address = None if http_port is None else ("0.0.0.0", int(http_port))
+    server = SQLServer(("0.0.0.0", 53326), db_name, path=unix_path, http_address=http_address,
+                       restore_from=restore_from, idle_timeout=IDLE_TIMEOUT)
     print("STARTING TO LISTEN")
     server.listen()
 
 
 if __name__ == "__main__":
-    try:
-        main(sys.argv[1])
-    except IndexError:
-        main()
+    main(*sys.argv[1:5])
@@ -0,0 +1,130 @@
+import cgi
+import threading
+
+
+HTML_SPLITTER = "            <tbody>\n"
+
+PLAYER_ROW = ("                <tr id = '{0} {1}'>\n"
+              "                    <td>{0}</td>\n"
+              "                    <td>{1}</td>\n"
+              "                    <td>{2}</td>\n"
+              "                    <td>{3}</td>\n"
+              "                    <td>{4}</td>\n"
+              "                    <td>{5}</td>\n"
+              "                    <td>{6}</td>\n"
+              "                </tr>\n")
+
+TEAM_ROW = ("                <tr id = '{0}'>\n"
+            "                    <td>{0}</td>\n"
+            "                    <td>{1}</td>\n"
+            "                    <td>{2}</td>\n"
+            "                    <td>{3}</td>\n"
+            "                    <td>{4}</td>\n"
+            "                    <td>{5}</td>\n"
+            "                    <td>{6}</td>\n"
+            "                    <td><a href = '{7}' target = '_blank'>{7}</a></td>\n"
+            "                </tr>\n")
+
+
+class Template(object):
+    """An HTML page with a table. The page is read and split around the table's body once,
+    and rows are formatted straight into any object with a write method."""
+    def __init__(self, path, row_format, row_values, splitter=HTML_SPLITTER):
+        """path is the HTML file, which must contain splitter once, where the rows go.
+        row_format is a string.format format for a row, and row_values is a callable
+        that returns the values to format a row with from the arguments passed to render_row."""
+        with open(path, "r") as f:
+            opening, self.ending = f.read().split(splitter)
+        self.opening = opening + splitter
+        self._format = row_format.format
+        self._row_values = row_values
+
+    def render_row(self, *args):
+        """Returns the HTML of one row, with its values escaped."""
+        return self._format(*[_escape(value) for value in self._row_values(*args)])
+
+    def write(self, out, rows):
+        """Writes the page to out, rendering each item of rows (a tuple of arguments for render_row)
+        as it is reached, so rows can be a generator and the page is never held in memory."""
+        out.write(self.opening)
+        for row in rows:
+            out.write(self.render_row(*row))
+        out.write(self.ending)
+
+
+class FragmentCache(object):
+    """Keeps the rendered rows of a Template by the id of the row's object (the first argument of every row),
+    so rows of objects that did not change are not rendered again.
+    Call invalidate with the ids of the objects that changed. Thread safe."""
+    def __init__(self, template):
+        """Create an empty FragmentCache for the template."""
+        self.template = template
+        self.generation = 0     # Changes on every invalidation.
+        self._fragments = {}    # id: (the other arguments of the row, the rendered row)
+        self._lock = threading.Lock()
+
+    def render_row(self, obj, *args, **kwargs):
+        """Returns the HTML of the row, rendering it only if it is not kept already.
+        If generation is given, a newly rendered row is only kept if nothing was invalidated since
+        self.generation was equal to it, since obj may be older than the invalidation."""
+        entry = self._fragments.get(obj.id)
+        if entry is not None and entry[0] == args:
+            return entry[1]
+        fragment = self.template.render_row(obj, *args)
+        generation = kwargs.get("generation")
+        with self._lock:
+            if generation is None or generation == self.generation:
+                self._fragments[obj.id] = (args, fragment)
+        return fragment
+
+    def write(self, out, rows, generation=None):
+        """Like Template.write, using the kept rows. See render_row help about generation."""
+        out.write(self.template.opening)
+        for row in rows:
+            out.write(self.render_row(*row, generation=generation))
+        out.write(self.template.ending)
+
+    def invalidate(self, *ids):
+        """Forget the rows of the objects with the ids."""
+        with self._lock:
+            self.generation += 1
+            for obj_id in ids:
+                self._fragments.pop(obj_id, None)
+
+    def clear(self):
+        """Forget all the rows."""
+        with self._lock:
+            self.generation += 1
+            self._fragments.clear()
+
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def players(path):
+    """Returns the Template of the players page at path. Its rows are rendered from (player, team) arguments."""
+    return _load(path, PLAYER_ROW, lambda player, team: (player.first_name, player.last_name, team, player.number,
+                                                         player.age, player.rings, player.nationality))
+
+
+def teams(path):
+    """Returns the Template of the teams page at path. Its rows are rendered from (team, ) arguments."""
+    return _load(path, TEAM_ROW, lambda team: (team.name, team.state, team.city, team.division.conference,
+                                               team.division.division, team.arena, team.championships,
+                                               team.website))
+
+
+def _load(path, row_format, row_values):
+    """Returns the Template for path, reading the file only the first time."""
+    with _templates_lock:
+        if path not in _templates:
+            _templates[path] = Template(path, row_format, row_values)
+        return _templates[path]
+
+
+def _escape(value):
+    """Returns value as an HTML escaped (UTF-8) string."""
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return cgi.escape(str(value), quote=True).replace("'", "&#39;")
@@ -0,0 +1,127 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """rate tokens are added every second, up to burst. Not thread safe, RateLimiter locks around it."""
+    def __init__(self, rate, burst):
+        """Create a full TokenBucket."""
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def refill(self, now):
+        """Add the tokens of the time since the last refill."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self):
+        """Returns the seconds until a token can be taken (0 if one can be now). Call refill first."""
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter(object):
+    """Thread safe token bucket limits on the requests of every client address, on all its requests
+    and on its requests with every verb."""
+
+    prune_every = 1000  # Checks between removals of the buckets of clients that did not send requests lately.
+
+    def __init__(self, rate=None, burst=None, verb_rates=None):
+        """rate is the requests per second every address may send (None for no limit), and burst is the number
+        it may send at once (rate if omitted).
+        verb_rates is a dict of verb: (rate, burst), the limits of every address on its requests with the verb."""
+        self.rate = rate
+        self.burst = burst or rate
+        self.verb_rates = verb_rates or {}
+        self.limited = {}   # verb: requests rejected.
+        self._buckets = {}  # address or (address, verb): TokenBucket
+        self._lock = threading.Lock()
+        self._checks = 0
+
+    def check(self, address, verb):
+        """Takes a token for a request of the address with the verb.
+        Returns 0 if the request may be answered, otherwise the seconds until it may be sent again."""
+        keys = []
+        if self.rate is not None:
+            keys.append((address, self.rate, self.burst))
+        if verb in self.verb_rates:
+            keys.append(((address, verb), ) + tuple(self.verb_rates[verb]))
+        if not keys:
+            return 0
+        now = time.time()
+        with self._lock:
+            self._checks += 1
+            if self._checks % self.prune_every == 0:
+                self._prune(now)
+            buckets = []
+            for key, rate, burst in keys:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = TokenBucket(rate, burst)
+                bucket.refill(now)
+                buckets.append(bucket)
+            wait = max(bucket.wait() for bucket in buckets)
+            if wait:
+                self.limited[verb] = self.limited.get(verb, 0) + 1
+                return wait
+            for bucket in buckets:
+                bucket.tokens -= 1
+            return 0
+
+    def _prune(self, now):
+        """Remove the buckets that are full again, they are the same as new ones. Must be called with the lock."""
+        for key, bucket in self._buckets.items():
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._buckets[key]
+
+    def as_dict(self):
+        """Returns the counters as a dict."""
+        with self._lock:
+            return {"limited": dict(self.limited), "clients": len(self._buckets)}
+
+
+class LoadShedder(object):
+    """Rejects requests while the server is overloaded: when more than max_in_flight requests are being answered
+    at once, or when the SQL of the recent requests took more than max_sql_seconds on average (waiting for
+    the locks of SQLite is most of it when the server is overloaded). Thread safe."""
+    def __init__(self, max_in_flight=None, max_sql_seconds=None, retry_after=0.1, smoothing=0.1):
+        """retry_after is the seconds rejected clients are told to wait.
+        smoothing is the weight of the newest request in the moving average of the SQL seconds."""
+        self.max_in_flight = max_in_flight
+        self.max_sql_seconds = max_sql_seconds
+        self.retry_after = retry_after
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.sql_seconds = 0.0
+        self.shed = {}  # verb: requests rejected.
+        self._lock = threading.Lock()
+
+    def start(self, verb):
+        """Called before a request with the verb is answered.
+        Returns 0 if it may be answered (then done must be called after it), otherwise the seconds
+        until it may be sent again."""
+        with self._lock:
+            overloaded = self.max_in_flight is not None and self.in_flight >= self.max_in_flight
+            if self.max_sql_seconds is not None and self.sql_seconds > self.max_sql_seconds:
+                overloaded = True
+                self.sql_seconds *= 1 - self.smoothing  # So requests are let in again to measure it once it is over.
+            if overloaded:
+                self.shed[verb] = self.shed.get(verb, 0) + 1
+                return self.retry_after
+            self.in_flight += 1
+            return 0
+
+    def done(self, sql_seconds):
+        """Called after a request that start let in was answered, with the seconds its SQL took."""
+        with self._lock:
+            self.in_flight -= 1
+            self.sql_seconds += (sql_seconds - self.sql_seconds) * self.smoothing
+
+    def as_dict(self):
+        """Returns the counters as a dict."""
+        with self._lock:
+            return {"shed": dict(self.shed), "in_flight": self.in_flight, "sql_seconds": self.sql_seconds}
@@ -0,0 +1,253 @@
+import bisect
+import threading
+import time
+
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The parts a request's time is split into.
+PHASES = ("decode", "sql", "serialize", "send")
+
+
+class Histogram(object):
+    """Counts of values by BUCKETS, with their sum. Not thread safe, Metrics locks around it."""
+    def __init__(self, buckets=BUCKETS):
+        """Create an empty Histogram with the bucket upper bounds given."""
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)    # The last one is for values over the biggest bucket.
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Count a value."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Returns a list of (upper bound, number of values up to it), ending with (float("inf"), count)."""
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float("inf"), ), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def as_dict(self):
+        """Returns the histogram as a dict."""
+        return {"count": self.count, "sum": self.sum,
+                "buckets": [(bound, count) for bound, count in self.cumulative() if bound != float("inf")]}
+
+
+class RequestTimer(object):
+    """Times one request. Call mark at the end of every phase, and Metrics.record when the request is done."""
+    def __init__(self, verb, sock, bytes_in=None):
+        """verb is the request, and sock is the Sock it came on.
+        bytes_in is sock.bytes_received before the request was received, if it was read already."""
+        self.verb = verb
+        self.table = ""
+        self.error = False
+        self.deadline = None    # Seconds the SQL of the request may run for, if limited.
+        self.phases = {}
+        self.start = self._last = time.time()
+        self._sock = sock
+        self._bytes_in = sock.bytes_received if bytes_in is None else bytes_in
+        self._bytes_out = sock.bytes_sent
+        self.finished = False
+
+    def mark(self, phase):
+        """Count the time since the last mark (or the start) as time spent in phase."""
+        now = time.time()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def finish(self):
+        """Stop the timer. Returns (seconds, bytes received, bytes sent) for the request."""
+        self.finished = True
+        return (time.time() - self.start, self._sock.bytes_received - self._bytes_in,
+                self._sock.bytes_sent - self._bytes_out)
+
+
+class Metrics(object):
+    """Thread safe per verb and table statistics of the requests a SQLServer answered."""
+    def __init__(self):
+        """Create an empty Metrics object."""
+        self._lock = threading.Lock()
+        self._requests = {}     # (verb, table): _RequestStats
+        self.connections = 0
+        self.connections_total = 0
+        self.connections_reaped = 0
+
+    def connected(self):
+        """Count a new connection."""
+        with self._lock:
+            self.connections += 1
+            self.connections_total += 1
+
+    def disconnected(self, reaped=False):
+        """Count a closed connection. reaped is whether the server closed it for being idle."""
+        with self._lock:
+            self.connections -= 1
+            if reaped:
+                self.connections_reaped += 1
+
+    def record(self, timer):
+        """Add a request timed with a RequestTimer. Does nothing if it was recorded already."""
+        if timer.finished:
+            return
+        seconds, bytes_in, bytes_out = timer.finish()
+        key = (timer.verb, timer.table)
+        with self._lock:
+            stats = self._requests.get(key)
+            if stats is None:
+                stats = self._requests[key] = _RequestStats()
+            stats.total.observe(seconds)
+            for phase, phase_seconds in timer.phases.iteritems():
+                stats.phases[phase].observe(phase_seconds)
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+            if timer.error:
+                stats.errors += 1
+
+    def as_dict(self):
+        """Returns the statistics as a dict of verb: {table: statistics}."""
+        with self._lock:
+            result = {}
+            for (verb, table), stats in self._requests.iteritems():
+                result.setdefault(verb, {})[table] = {
+                    "seconds": stats.total.as_dict(), "errors": stats.errors,
+                    "bytes_in": stats.bytes_in, "bytes_out": stats.bytes_out,
+                    "phases": dict((phase, histogram.as_dict()) for phase, histogram in stats.phases.iteritems())}
+            return result
+
+    def prometheus(self, prefix="sqlserver", extra=None):
+        """Returns the statistics in the Prometheus text format.
+        extra is an optional dict of name: number, added as untyped metrics with the prefix."""
+        lines = []
+        with self._lock:
+            requests = sorted(self._requests.iteritems())
+            lines += ["# HELP %s_request_seconds Time to answer requests." % prefix,
+                      "# TYPE %s_request_seconds histogram" % prefix]
+            for (verb, table), stats in requests:
+                lines += _histogram_lines(prefix + "_request_seconds", stats.total,
+                                          'verb="%s",table="%s"' % (verb, table))
+            lines += ["# HELP %s_request_phase_seconds Time spent in every phase of answering requests." % prefix,
+                      "# TYPE %s_request_phase_seconds histogram" % prefix]
+            for (verb, table), stats in requests:
+                for phase in PHASES:
+                    if stats.phases[phase].count:
+                        lines += _histogram_lines(prefix + "_request_phase_seconds", stats.phases[phase],
+                                                  'verb="%s",table="%s",phase="%s"' % (verb, table, phase))
+            for name, attribute, description in (("request_errors_total", "errors", "Requests answered with an error."),
+                                                 ("received_bytes_total", "bytes_in", "Bytes of requests received."),
+                                                 ("sent_bytes_total", "bytes_out", "Bytes of answers sent.")):
+                lines += ["# HELP %s_%s %s" % (prefix, name, description), "# TYPE %s_%s counter" % (prefix, name)]
+                for (verb, table), stats in requests:
+                    lines.append('%s_%s{verb="%s",table="%s"} %d' % (prefix, name, verb, table,
+                                                                       getattr(stats, attribute)))
+            lines += ["# HELP %s_connections Connected clients." % prefix, "# TYPE %s_connections gauge" % prefix,
+                      "%s_connections %d" % (prefix, self.connections),
+                      "# HELP %s_connections_total Clients that connected." % prefix,
+                      "# TYPE %s_connections_total counter" % prefix,
+                      "%s_connections_total %d" % (prefix, self.connections_total),
+                      "# HELP %s_connections_reaped_total Clients disconnected for being idle." % prefix,
+                      "# TYPE %s_connections_reaped_total counter" % prefix,
+                      "%s_connections_reaped_total %d" % (prefix, self.connections_reaped)]
+        for name, value in sorted((extra or {}).iteritems()):
+            lines += ["# TYPE %s_%s untyped" % (prefix, name), "%s_%s %s" % (prefix, name, repr(value))]
+        return "\n".join(lines) + "\n"
+
+
+class MemoryAccount(object):
+    """Thread safe counters of the bytes of the answers a SQLServer holds in memory while sending them,
+    in total and per connection, with their high-water marks.
+    Python 2 has no tracemalloc, so only the pickled answers are counted, which are most of the memory
+    a big request takes."""
+    def __init__(self):
+        """Create an empty MemoryAccount."""
+        self._lock = threading.Lock()
+        self.in_flight = 0          # Bytes of the answers being sent now.
+        self.peak_in_flight = 0
+        self.largest_response = 0
+        self.responses = 0
+        self.response_bytes = 0
+        self.rejected_responses = 0
+        self._connections = {}      # name: {"in_flight": ..., "largest_response": ..., ...}
+
+    def connected(self, name):
+        """Start counting for a new connection."""
+        with self._lock:
+            self._connections[name] = {"in_flight": 0, "largest_response": 0, "response_bytes": 0,
+                                       "rejected_responses": 0}
+
+    def disconnected(self, name):
+        """Stop counting for a closed connection."""
+        with self._lock:
+            self._connections.pop(name, None)
+
+    def hold(self, name, size):
+        """Count an answer of size bytes that the connection started sending."""
+        with self._lock:
+            self.in_flight += size
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            self.largest_response = max(self.largest_response, size)
+            self.responses += 1
+            self.response_bytes += size
+            connection = self._connections.get(name)
+            if connection is not None:
+                connection["in_flight"] += size
+                connection["largest_response"] = max(connection["largest_response"], size)
+                connection["response_bytes"] += size
+
+    def release(self, name, size):
+        """Count an answer of size bytes that the connection finished sending."""
+        with self._lock:
+            self.in_flight -= size
+            connection = self._connections.get(name)
+            if connection is not None:
+                connection["in_flight"] -= size
+
+    def rejected(self, name):
+        """Count an answer that was too big to send."""
+        with self._lock:
+            self.rejected_responses += 1
+            connection = self._connections.get(name)
+            if connection is not None:
+                connection["rejected_responses"] += 1
+
+    def as_dict(self):
+        """Returns the counters as a dict, with the counters of every connection under "connections"."""
+        with self._lock:
+            return {"in_flight": self.in_flight, "peak_in_flight": self.peak_in_flight,
+                    "largest_response": self.largest_response, "responses": self.responses,
+                    "response_bytes": self.response_bytes, "rejected_responses": self.rejected_responses,
+                    "connections": dict((name, dict(counters)) for name, counters in self._connections.iteritems())}
+
+
+class _RequestStats(object):
+    """The statistics of the requests with one verb on one table."""
+    def __init__(self):
+        self.total = Histogram()
+        self.phases = dict((phase, Histogram()) for phase in PHASES)
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+def percentile(values, percent):
+    """Returns the percentile of a sorted list (0.0 for an empty one)."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def _histogram_lines(name, histogram, labels):
+    """Returns the Prometheus text lines of a histogram with the labels (a string like 'verb="GET"')."""
+    lines = []
+    for bound, count in histogram.cumulative():
+        lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, "+Inf" if bound == float("inf") else repr(bound),
+                                                    count))
+    lines.append("%s_sum{%s} %r" % (name, labels, histogram.sum))
+    lines.append("%s_count{%s} %d" % (name, labels, histogram.count))
+    return lines
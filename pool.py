@@ -0,0 +1,191 @@
+import socket
+import threading
+import time
+import contextlib
+import collections
+from protocol import SQLClient
+from metrics import percentile
+
+
+class PoolTimeout(socket.timeout):
+    """An exception to show no client became available in a SQLClientPool before the checkout timeout."""
+    pass
+
+
+class SQLClientPool(object):
+    """A thread safe pool of connected SQLClient objects.
+    Threads check a client out, use it alone, and check it back in for other threads to reuse,
+    so connections (and the READY handshake) are not made again for every request."""
+
+    wait_samples = 1000     # Number of the latest checkout wait times kept for the statistics.
+
+    def __init__(self, address, min_size=1, max_size=10, timeout=None, max_idle=60, client_class=SQLClient,
+                 **client_kwargs):
+        """Create a new SQLClientPool object and connect min_size clients.
+        address is the (ip, port) combination you would pass to socket.bind,
+        or the path of the unix domain socket the server listens on.
+        max_size is the maximum number of clients connected at once.
+        timeout is the default number of seconds checkout waits for a client (None waits forever).
+        Idle clients over min_size are disconnected after max_idle seconds.
+        The clients are created with client_class(address, **client_kwargs)."""
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError("'min_size' must be between 0 and 'max_size', and 'max_size' must be at least 1.")
+        self.address = address
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._client_class = client_class
+        self._client_kwargs = client_kwargs
+        self._idle = []     # (client, time it was checked in) tuples, the most recent last.
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition(threading.Lock())
+        self._waits = collections.deque(maxlen=SQLClientPool.wait_samples)
+        self._checkouts = 0
+        self._timeouts = 0
+        self._created = 0
+        self._evicted = 0
+        self._broken = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        for _ in xrange(min_size):
+            client = self._connect()
+            with self._condition:
+                self._size += 1
+                self._created += 1
+                self._idle.append((client, time.time()))
+
+    def checkout(self, timeout=-1):
+        """Returns a connected client, which must be given back with checkin.
+        If all max_size clients are checked out, waits up to timeout seconds
+        (the pool's timeout if omitted, None waits forever) and raises PoolTimeout if none was checked in."""
+        if timeout == -1:
+            timeout = self.timeout
+        start = time.time()
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise socket.error("The pool is closed.")
+                self._evict_idle()
+                while self._idle:
+                    client = self._idle.pop()[0]
+                    if client.sock.peer_closed():    # Health check, the server closed the connection.
+                        self._discard(client)
+                        continue
+                    self._record_wait(time.time() - start)
+                    return client
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = None if timeout is None else start + timeout - time.time()
+                if remaining is not None and remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout("No client was available for %s seconds." % timeout)
+                self._condition.wait(remaining)
+        try:
+            client = self._connect()
+        except socket.error:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._created += 1
+            self._record_wait(time.time() - start)
+        return client
+
+    def checkin(self, client, broken=False):
+        """Give back a client returned from checkout.
+        If broken is True (the connection failed while it was used), the client is disconnected instead."""
+        with self._condition:
+            if broken or self._closed:
+                self._discard(client, broken)
+            else:
+                self._idle.append((client, time.time()))
+                self._evict_idle()
+            self._condition.notify()
+
+    @contextlib.contextmanager
+    def client(self, timeout=-1):
+        """Use with the 'with' statement to check out a client, and check it back in at the end.
+        A client that raised socket.error is not reused."""
+        client = self.checkout(timeout)
+        try:
+            yield client
+        except socket.error:
+            self.checkin(client, broken=True)
+            raise
+        except:
+            self.checkin(client)
+            raise
+        self.checkin(client)
+
+    def receive(self, table, ratio="=", **constraints):
+        """See SQLClient.receive help."""
+        with self.client() as client:
+            return client.receive(table, ratio, **constraints)
+
+    def add(self, table, **values):
+        """See SQLClient.add help."""
+        with self.client() as client:
+            return client.add(table, **values)
+
+    def update(self, table, obj_id, **updates):
+        """See SQLClient.update help."""
+        with self.client() as client:
+            return client.update(table, obj_id, **updates)
+
+    def delete(self, table, obj_id):
+        """See SQLClient.delete help."""
+        with self.client() as client:
+            return client.delete(table, obj_id)
+
+    def stats(self):
+        """Returns a dict with the size of the pool and statistics about the time checkout waited (in seconds).
+        The percentiles are of the latest SQLClientPool.wait_samples checkouts."""
+        with self._condition:
+            waits = sorted(self._waits)
+            return {"size": self._size, "idle": len(self._idle), "in_use": self._size - len(self._idle),
+                    "checkouts": self._checkouts, "timeouts": self._timeouts, "created": self._created,
+                    "evicted": self._evicted, "broken": self._broken,
+                    "wait_mean": self._total_wait / self._checkouts if self._checkouts else 0.0,
+                    "wait_max": self._max_wait, "wait_p50": percentile(waits, 50),
+                    "wait_p95": percentile(waits, 95), "wait_p99": percentile(waits, 99)}
+
+    def close(self):
+        """Disconnect the idle clients. Clients checked out are disconnected when they are checked in."""
+        with self._condition:
+            self._closed = True
+            while self._idle:
+                self._discard(self._idle.pop()[0], broken=False)
+            self._condition.notify_all()
+
+    def _connect(self):
+        """Create and connect a new client."""
+        client = self._client_class(self.address, **self._client_kwargs)
+        client.connect()
+        return client
+
+    def _discard(self, client, broken=True):
+        """Disconnect a client that will not be reused. Must be called with the lock acquired."""
+        self._size -= 1
+        if broken:
+            self._broken += 1
+        client.sock.close()
+
+    def _evict_idle(self):
+        """Disconnect the clients idle for over max_idle seconds, while keeping min_size clients.
+        Must be called with the lock acquired."""
+        oldest = time.time() - self.max_idle
+        while self._idle and self._idle[0][1] < oldest and self._size > self.min_size:
+            self._idle.pop(0)[0].sock.close()
+            self._size -= 1
+            self._evicted += 1
+
+    def _record_wait(self, wait):
+        """Add the time a checkout waited to the statistics. Must be called with the lock acquired."""
+        self._checkouts += 1
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+        self._waits.append(wait)
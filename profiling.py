@@ -0,0 +1,73 @@
+import cProfile
+import pstats
+import threading
+import time
+
+
+class ProfileSession(object):
+    """Profiles calls with cProfile, from any number of threads, until a number of calls were profiled
+    or a number of seconds passed. Then the aggregated statistics are written to a file
+    that can be read with pstats."""
+    def __init__(self, path, requests=None, seconds=None):
+        """path is the file to write the statistics to.
+        The session ends after requests calls were profiled, or after seconds seconds (whichever comes first)."""
+        if requests is None and seconds is None:
+            raise ValueError("Either 'requests' or 'seconds' must be given.")
+        self.path = path
+        self.profiled = 0
+        self.done = False
+        self._left = requests   # Calls that can still start to be profiled.
+        self._running = 0
+        self._stats = None
+        self._lock = threading.Lock()
+        self._timer = None
+        if seconds is not None:
+            self._timer = threading.Timer(seconds, self.finish)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def run(self, func, *args):
+        """Calls func with args and returns what it returns, profiling the call if the session is not over."""
+        with self._lock:
+            profile = not self.done and (self._left is None or self._left > 0)
+            if profile:
+                self._running += 1
+                if self._left is not None:
+                    self._left -= 1
+        if not profile:
+            return func(*args)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args)
+        finally:
+            self._add(profiler)
+
+    def _add(self, profiler):
+        """Add the statistics of a profiled call, and end the session if it was the last one."""
+        with self._lock:
+            self._running -= 1
+            if self.done:
+                return      # Ended by time while the call ran.
+            self.profiled += 1
+            if self._stats is None:
+                self._stats = pstats.Stats(profiler)
+            else:
+                self._stats.add(profiler)
+            if self._left == 0 and self._running == 0:
+                self._write()
+
+    def finish(self):
+        """End the session now and write the statistics of the calls profiled until now."""
+        with self._lock:
+            if not self.done:
+                self._write()
+
+    def _write(self):
+        """Write the statistics and mark the session done. Must be called with the lock acquired."""
+        self.done = True
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._stats is not None:
+            self._stats.dump_stats(self.path)
+        else:
+            open(self.path, "w").close()    # Nothing was profiled, leave an empty file to show it ended.
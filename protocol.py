@@ -1,19 +1,34 @@
 import socket
+import sock as sock_module
 from sock import Sock
 import abc
 import threading
 import cPickle as pickle
 import SQL_ORM
 import sqlite3
+import random
+import select
+import Queue
+import os
+import stat
+import html_http
+import metrics
+import profiling
+import backup
+import limits
+import time
+import re
+import collections
 
 
 class TCP(object):
     __metaclass__ = abc.ABCMeta
 
     @abc.abstractmethod
-    def __init__(self, (ip, port)):
+    def __init__(self, (ip, port), path=None):
         self.ip = ip
         self.port = port
+        self.path = path    # Path of a unix domain socket.
 
 
 class Server(TCP):
@@ -21,10 +36,14 @@ class Server(TCP):
 
     ready = "READY"
 
-    def __init__(self, (ip, port)):
+    keepalive = None    # (idle, interval, count) of the TCP keepalive of accepted clients, see Sock.set_keepalive.
+    stop_check_interval = 0.5   # Most seconds listen takes to notice stop_listening while no client connects.
+
+    def __init__(self, (ip, port), path=None):
         """(ip, port) is the ip and port combination you would pass to socket.bind.
-        db_name is the name of the DB excluding file name extension (.db assumed)."""
-        super(Server, self).__init__((ip, port))
+        If path is given, the server also listens on a unix domain socket at path,
+        which is faster for clients on the same host. Use (None, None) to only listen on path."""
+        super(Server, self).__init__((ip, port), path)
         self._keep_listening = False
 
     def listen(self, handler=lambda sock: None, backlog=5, verify_join=True, verbose=True, **kwargs):
@@ -38,22 +57,52 @@ class Server(TCP):
         join all client threads once the server is closed or not."""
         self._keep_listening = True
         client_threads = []
-        sock = Sock()
-        sock.bind((self.ip, self.port))
-        sock.listen(backlog)
-        while self._keep_listening:
-            client_sock, client_addr = sock.accept()
-            Server.connect(client_sock)
-            _printif(verbose, "Connected to client @ %s" % client_addr[0])
-            client = threading.Thread(target=handler, args=(client_sock, ), kwargs=kwargs)
-            client_threads.append(client)
-            client.start()
+        listeners = []
+        if self.port is not None:
+            sock = Sock()
+            sock.bind((self.ip, self.port))
+            sock.listen(backlog)
+            listeners.append(sock)
+        if self.path is not None:
+            listeners.append(self._listen_unix(backlog))
+        try:
+            while self._keep_listening:
+                for listener in select.select(listeners, [], [], Server.stop_check_interval)[0]:
+                    client_sock = listener.accept()[0]
+                    if client_sock.family == socket.AF_INET:
+                        client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)     # Requests are small.
+                        if self.keepalive is not None:
+                            client_sock.set_keepalive(*self.keepalive)
+                    Server.connect(client_sock)
+                    _printif(verbose, "Connected to client @ %s" % _address(client_sock))
+                    client = threading.Thread(target=handler, args=(client_sock, ), kwargs=kwargs)
+                    client_threads = [thread for thread in client_threads if thread.is_alive()]
+                    client_threads.append(client)
+                    client.start()
+        finally:
+            for listener in listeners:
+                listener.close()
+            if self.path is not None:
+                os.remove(self.path)
         if verify_join:
             Server.join(timeout=None, *client_threads)
         self._keep_listening = False
 
+    def _listen_unix(self, backlog):
+        """Returns a Sock listening on the unix domain socket at self.path.
+        A socket file left there by a server that did not exit cleanly is replaced."""
+        try:
+            if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                os.remove(self.path)
+        except OSError:
+            pass    # No file there.
+        sock = Sock(socket.AF_UNIX)
+        sock.bind(self.path)
+        sock.listen(backlog)
+        return sock
+
     def stop_listening(self):
-        """Stop listening for and accepting new clients."""
+        """Stop listening for and accepting new clients. listen returns within stop_check_interval seconds."""
         self._keep_listening = False
 
     @staticmethod
@@ -64,7 +113,7 @@ class Server(TCP):
         try:
             sock.send_by_size(Server.ready)
         except socket.error:
-            raise socket.error("Connection to client @ %s failed." % sock.getpeername()[0])
+            raise socket.error("Connection to client @ %s failed." % _address(sock))
 
     @staticmethod
     def join(timeout=None, *threads):
@@ -75,19 +124,76 @@ class Server(TCP):
 
 class Client(TCP):
     """An object that makes it easier to use the protocol to communicate with the server."""
-    def __init__(self, (ip, port)):
-        """(ip, port) is the ip and port combination you would pass to socket.bind.."""
-        self.sock = Sock()
-        super(Client, self).__init__((ip, port))
+    def __init__(self, address):
+        """address is the (ip, port) combination you would pass to socket.bind,
+        or the path of the unix domain socket the server listens on (see Server)."""
+        if isinstance(address, basestring):
+            self.sock = Sock(socket.AF_UNIX)
+            super(Client, self).__init__((None, None), address)
+        else:
+            self.sock = Sock()
+            super(Client, self).__init__(address)
+
+    def reconnect(self):
+        """Close the connection and connect to the server again, like after the server closed it."""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass    # Closed already.
+        family = self.sock.family
+        self.sock.close()
+        self.sock = Sock(family)
+        self.connect()
 
     def connect(self):
         """Connect to the server."""
         try:
-            self.sock.connect((self.ip, self.port))
+            if self.path is not None:
+                self.sock.connect(self.path)
+            else:
+                self.sock.connect((self.ip, self.port))
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             if self.sock.recv_by_size() != Server.ready:
                 raise socket.error
         except socket.error:
-            raise socket.error("Connection to server @ %s failed." % self.sock.getpeername()[0])
+            raise socket.error("Connection to server @ %s failed." % (self.path or self.ip))
+
+
+class _TaggedSock(object):
+    """Wraps a Sock so every answer sent through it is tagged with the id of the request it answers."""
+    def __init__(self, sock, tag):
+        self._sock = sock
+        self.tag = tag
+
+    def send_by_size(self, s):
+        """Like Sock.send_by_size, with the tag before s."""
+        self._sock.send_by_size(self.tag + "~" + s)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+class _UnansweredSock(object):
+    """Wraps a Sock so answers are not sent through it, for requests the client does not wait for."""
+    def __init__(self, sock):
+        self._sock = sock
+
+    def send_by_size(self, s):
+        """Does nothing, the client does not read answers to these requests."""
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+def _address(sock):
+    """Returns the address of the other side of a connected socket, to show to the user."""
+    try:
+        if sock.family == getattr(socket, "AF_UNIX", None):    # No unix domain sockets on Windows.
+            return sock.getsockname() or "unix socket"
+        return sock.getpeername()[0]
+    except socket.error:
+        return "unknown address"
 
 
 def _printif(i, *s):
@@ -101,12 +207,128 @@ class SQLServer(Server):
 
     success = "SUCCESS"
     failure = "FAILURE"
+    not_modified = "NOT MODIFIED"
+    pong = "PONG"
 
-    def __init__(self, (ip, port), db_name="ORM"):
+    subscription_check_interval = 5     # Seconds between checks that an idle subscriber is still connected.
+
+    verbs = ("GET", "GETIF", "ADD", "UPDATE", "DELETE", "SUBSCRIBE", "CHANGES", "COMPRESS", "STATS", "PROFILE",
+             "PING")
+    unanswered_verbs = ("ADD", "UPDATE", "DELETE")  # Verbs that can be sent after NOREPLY.
+    unlimited_verbs = ("COMPRESS", "STATS", "PING")     # Verbs that are never rate limited or shed.
+    shed_verbs = ("GET", "GETIF", "ADD", "UPDATE", "DELETE", "CHANGES")     # Verbs shed when overloaded.
+    query_verbs = ("GET", "GETIF", "CHANGES")   # Verbs whose rows max_response_size limits while they are read.
+
+    def __init__(self, (ip, port), db_name="ORM", subscriber_queue_size=1000, path=None,
+                 compression=("zlib-fast", "zlib"), compress_threshold=Sock.compress_threshold, http_address=None,
+                 max_response_size=None, restore_from=None, hot=False, async_writes=False, group_commit=None,
+                 query_deadline=None, limiter=None, shedder=None, idle_timeout=None, keepalive=(60, 10, 5),
+                 profile_dir=None):
         """(ip, port) is the ip and port combination you would pass to socket.bind.
-        db_name is the name of the DB excluding file name extension (.db assumed)."""
-        super(SQLServer, self).__init__((ip, port))
-        self.orm = SQL_ORM.ORM(db_name)
+        db_name is the name of the DB excluding file name extension (.db assumed).
+        path is the path of a unix domain socket to listen on as well (see Server).
+        compression is the codecs (keys of sock.CODECS) clients may ask to compress their connection with,
+        and compress_threshold is the size from which frames are compressed.
+        If http_address (an (ip, port) combination) is given, the players and teams HTML pages are also served
+        over HTTP there while listening, at /players and /teams (see html_http).
+        subscriber_queue_size is the number of events kept for a subscriber that did not get them yet,
+        after that its events are dropped and it is told to resync (see SQLClient.next_event).
+        If max_response_size is given, answers bigger than it (in pickled bytes) are replaced with
+        a RESPONSE TOO LARGE error, so one request cannot make the server hold an unbounded answer in memory.
+        The rows of GET, GETIF and CHANGES requests are given up as soon as their values alone are bigger
+        (see SQL_ORM.ORM.set_size_limit), before the whole answer is collected and pickled.
+        If restore_from (the path of a snapshot made with backup.create) is given, the DB is replaced with it first.
+        If hot is True, the DB is served from an in-memory copy, and writes are applied to the file after it,
+        in the background if async_writes is True (see SQL_ORM.ORM).
+        If group_commit (seconds) is given, the writes of concurrent clients made within that long of each other
+        are committed in one transaction (see SQL_ORM.ORM.group_commits).
+        query_deadline is the most seconds the SQL of a request may run before it is aborted and
+        a TIMEOUT error is sent instead, for clients that do not send a shorter deadline (None for no limit).
+        limiter (a limits.RateLimiter) limits the requests of every client address, and shedder
+        (a limits.LoadShedder) rejects requests while the server is overloaded. Rejected requests are answered
+        with a BUSY error right away, with the seconds to wait before sending them again
+        (requests sent with NOREPLY cannot be answered, so their connection is closed instead).
+        Clients of the unix domain socket are limited by connection, since they share one address.
+        Clients that send no request for idle_timeout seconds are disconnected (None to wait forever),
+        and keepalive is the TCP keepalive of the connections, so peers that are gone are disconnected too
+        (see Sock.set_keepalive, None to turn it off). Subscribers are not disconnected for being idle.
+        profile_dir is a directory for nothing but the files of PROFILE requests (created if missing).
+        PROFILE requests are refused unless it is given."""
+        super(SQLServer, self).__init__((ip, port), path)
+        if restore_from is not None:
+            backup.restore(restore_from, db_name)
+        self.orm = SQL_ORM.ORM(db_name, hot, async_writes)
+        if group_commit is not None:
+            self.orm.group_commits(group_commit)
+        self.subscriber_queue_size = subscriber_queue_size
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.compression_stats = sock_module.CompressionStats()
+        self.http_address = http_address
+        self._subscriptions = []
+        self._subscriptions_lock = threading.Lock()
+        self.orm.add_listener(self._publish, self.has_subscribers)
+        self._epoch = "%08x" % random.getrandbits(32)     # Versions from an older run never match.
+        self.metrics = metrics.Metrics()
+        self.memory = metrics.MemoryAccount()
+        self.max_response_size = max_response_size
+        self.query_deadline = query_deadline
+        self.limiter = limiter
+        self.shedder = shedder
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self._timers = threading.local()    # The RequestTimer of the request every thread is answering.
+        self.profile_dir = profile_dir
+        if profile_dir is not None and not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        self._profile = None    # The running profiling.ProfileSession.
+        self._profile_lock = threading.Lock()
+
+    def stats(self):
+        """Returns a dict with statistics about the server (see metrics.Metrics.as_dict about "requests")."""
+        stats = {"compression": self.compression_stats.as_dict(), "connections": self.metrics.connections,
+                 "connections_total": self.metrics.connections_total,
+                 "connections_reaped": self.metrics.connections_reaped, "requests": self.metrics.as_dict(),
+                 "memory": self.memory.as_dict()}
+        group_commit = self.orm.group_commit
+        if group_commit is not None:
+            stats["group_commit"] = group_commit.as_dict()
+        if self.limiter is not None:
+            stats["rate_limits"] = self.limiter.as_dict()
+        if self.shedder is not None:
+            stats["load_shedding"] = self.shedder.as_dict()
+        if self.orm.hot is not None:
+            stats["hot_copy"] = self.orm.hot.as_dict()
+        return stats
+
+    def prometheus(self):
+        """Returns the statistics about the server in the Prometheus text format."""
+        extra = dict(("compression_" + name, value) for name, value in self.compression_stats.as_dict().iteritems())
+        extra.update(("memory_" + name, value) for name, value in self.memory.as_dict().iteritems()
+                     if name != "connections")
+        group_commit = self.orm.group_commit
+        if group_commit is not None:
+            extra.update(("group_commit_" + name, value) for name, value in group_commit.as_dict().iteritems())
+        if self.limiter is not None:
+            extra["rate_limited"] = sum(self.limiter.as_dict()["limited"].itervalues())
+        if self.shedder is not None:
+            load = self.shedder.as_dict()
+            extra.update(shed=sum(load["shed"].itervalues()), in_flight=load["in_flight"],
+                         sql_seconds_average=load["sql_seconds"])
+        if self.orm.hot is not None:
+            hot = self.orm.hot.as_dict()
+            extra.update(hot_copy_write_errors=hot["write_errors"], hot_copy_queued_writes=hot["queued_writes"])
+        return self.metrics.prometheus(extra=extra)
+
+    def version(self, table):
+        """Returns the current version of the table, made of its latest changelog sequence, so it changes with
+        every write to the table, also by other processes (see SQL_ORM.ORM.last_change).
+        Raises KeyError for unknown tables, and sqlite3.Error if the changelog cannot be read."""
+        if table == "Roster":   # Changes with both tables.
+            return "%s.%d.%d" % (self._epoch, self.orm.last_change("Players"), self.orm.last_change("Teams"))
+        if table not in ("Players", "Teams"):
+            raise KeyError(table)
+        return "%s.%d" % (self._epoch, self.orm.last_change(table))
 
     def listen(self, handler=None, backlog=5, verify_join=True, verbose=True, **kwargs):
         """Listen for new client trying to connect and accept them.
@@ -116,46 +338,259 @@ class SQLServer(Server):
         the maximum value is system-dependent (usually 5), the minimum value is forced to 0.
         The verify_join argument specifies whether the function should
         join all client threads once the server is closed or not."""
-        if handler is None:
-            super(SQLServer, self).listen(self.handle_client, backlog=backlog, verify_join=verify_join, verbose=verbose,
-                                          announce=verbose)
-        else:
-            super(SQLServer, self).listen(handler, backlog=backlog, verify_join=verify_join, verbose=verbose, **kwargs)
+        http_server = None
+        if self.http_address is not None:
+            http_server = html_http.start(self, self.http_address, verbose)
+        try:
+            if handler is None:
+                super(SQLServer, self).listen(self.handle_client, backlog=backlog, verify_join=verify_join,
+                                              verbose=verbose, announce=verbose)
+            else:
+                super(SQLServer, self).listen(handler, backlog=backlog, verify_join=verify_join, verbose=verbose,
+                                              **kwargs)
+        finally:
+            if http_server is not None:
+                http_server.shutdown()
+                http_server.server_close()
+            self.orm.flush()
 
     def handle_client(self, sock, announce=True):
         """The function that Server.listen calls with new clients."""
-        while True:
-            try:
-                sock.settimeout(None)
-                self.get_request(sock)
-            except socket.error:
-                break
-        _printif(announce, "Client @ %s disconnected" % sock.getpeername()[0])
+        self.metrics.connected()
+        self._timers.connection = "%s#%d" % (_address(sock), sock.fileno())
+        self.memory.connected(self._timers.connection)
+        reaped = False
+        try:
+            while True:
+                try:
+                    sock.settimeout(self.idle_timeout)
+                    self.get_request(sock)
+                except socket.timeout:
+                    reaped = True
+                    break
+                except socket.error:
+                    break
+        finally:
+            self.metrics.disconnected(reaped)
+            self.memory.disconnected(self._timers.connection)
+        _printif(announce, "Client @ %s %s" % (_address(sock), "was idle, disconnected" if reaped else "disconnected"))
         sock.close()
 
     def get_request(self, sock):
         """Receives a request from the client, and calls the function that can answer it."""
         request = ""
+        bytes_in = sock.bytes_received
+        deadline = self.query_deadline
         try:
             request = sock.recv_by_size()
-            if request == SQLClient.get:
-                self.send(sock)
-            elif request == SQLClient.add_str:
-                self.add(sock)
-            elif request == SQLClient.update_str:
-                self.update(sock)
-            elif request == SQLClient.delete_str:
-                self.delete(sock)
-            else:
+            if request.startswith(SQLClient.tag_str + "~"):
+                sock = _TaggedSock(sock, request.split("~", 1)[1])
+                request = sock.recv_by_size()
+            elif request == SQLClient.no_reply_str:
+                sock = _UnansweredSock(sock)
+                request = sock.recv_by_size()
+                if request not in SQLServer.unanswered_verbs:
+                    raise socket.error
+            if request.startswith(SQLClient.deadline_str + "~"):
+                deadline = self._deadline(request.split("~", 1)[1])
+                request = sock.recv_by_size()
+            if request not in SQLServer.verbs:
                 raise socket.error
-        except socket.error:
+            timer = self._timers.current = metrics.RequestTimer(request, sock, bytes_in)
+            timer.deadline = deadline
+            self.orm.set_deadline(deadline)
+            if request in SQLServer.query_verbs:
+                self.orm.set_size_limit(self.max_response_size)
+            retry_after = self._admit(sock, request)
+            shed = not retry_after and self.shedder is not None and request in SQLServer.shed_verbs
+            try:
+                profile = self._profile
+                if profile is not None and profile.done:
+                    profile = None
+                if retry_after:
+                    self.busy(sock, retry_after)
+                elif profile is None or request in (SQLClient.subscribe_str, SQLClient.profile_str):
+                    self._answer(sock, request)
+                else:
+                    profile.run(self._answer, sock, request)
+            except socket.error:
+                timer.error = True
+                raise
+            finally:
+                if shed:
+                    self.shedder.done(timer.phases.get("sql", 0.0))
+                self.orm.set_deadline(None)
+                self.orm.set_size_limit(None)
+                self.metrics.record(timer)
+        except socket.error as e:
             if request == "":
-                raise socket.error("Client @ %s disconnected" % sock.getpeername()[0])
-            raise socket.error("Communication failed with client @ %s." % sock.getpeername()[0])
+                if isinstance(e, socket.timeout):
+                    raise socket.timeout("Client @ %s was idle for too long." % _address(sock))
+                raise socket.error("Client @ %s disconnected" % _address(sock))
+            raise socket.error("Communication failed with client @ %s." % _address(sock))
+
+    def _admit(self, sock, request):
+        """Returns 0 if the request may be answered, otherwise the seconds the client should wait before
+        sending it again (see limiter and shedder)."""
+        if request in SQLServer.unlimited_verbs:
+            return 0
+        if self.limiter is not None:
+            retry_after = self.limiter.check(self._client_key(sock), request)
+            if retry_after:
+                return retry_after
+        if self.shedder is not None and request in SQLServer.shed_verbs:
+            return self.shedder.start(request)
+        return 0
+
+    def _client_key(self, sock):
+        """Returns what the requests of the client are limited by: its address, or its connection for clients
+        of the unix domain socket (they all have the address of the server's socket)."""
+        if sock.family == getattr(socket, "AF_UNIX", None):
+            return self._timers.connection
+        return _address(sock)
+
+    def busy(self, sock, retry_after):
+        """Rejects a request without answering it, telling the client to send it again after retry_after seconds.
+        A request sent with NOREPLY cannot be told, so the connection is closed instead (socket.error is raised),
+        for the client to see that its requests were not all executed."""
+        sock.recv_by_size()     # The parameters of the request, every verb has one frame of them.
+        if isinstance(sock, _UnansweredSock):
+            raise socket.error("A request sent with NOREPLY was rejected.")
+        self._reply(sock, "ERROR~BUSY~008~%.3f" % retry_after)
+
+    def _deadline(self, seconds):
+        """Returns the deadline (in seconds) of a request the client sent seconds with,
+        which cannot be later than query_deadline. Raises socket.error if seconds is not a positive number."""
+        try:
+            seconds = float(seconds)
+        except ValueError:
+            raise socket.error
+        if not seconds > 0:
+            raise socket.error
+        return seconds if self.query_deadline is None else min(seconds, self.query_deadline)
+
+    def _answer(self, sock, request):
+        """Calls the function that answers the request (one of SQLServer.verbs)."""
+        if request == SQLClient.get:
+            self.send(sock)
+        elif request == SQLClient.conditional_get:
+            self.send_conditional(sock)
+        elif request == SQLClient.add_str:
+            self.add(sock)
+        elif request == SQLClient.update_str:
+            self.update(sock)
+        elif request == SQLClient.delete_str:
+            self.delete(sock)
+        elif request == SQLClient.subscribe_str:
+            self.subscribe(sock)
+        elif request == SQLClient.changes_str:
+            self.send_changes(sock)
+        elif request == SQLClient.compress_str:
+            self.negotiate_compression(sock)
+        elif request == SQLClient.stats_str:
+            self.send_stats(sock)
+        elif request == SQLClient.profile_str:
+            self.start_profiling(sock)
+        elif request == SQLClient.ping_str:
+            self.send_pong(sock)
+
+    def profile(self, path, requests=None, seconds=None):
+        """Profile the next requests requests, or the requests in the next seconds seconds (whichever ends first),
+        of all clients with cProfile, and write the aggregated statistics to path (read them with pstats).
+        Subscriptions are not profiled. Returns False if a profile is running already.
+        path must not exist (OSError is raised if it does), it is created right away so it is not taken meanwhile."""
+        with self._profile_lock:
+            if self._profile is not None and not self._profile.done:
+                return False
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+            self._profile = profiling.ProfileSession(path, requests, seconds)
+            return True
+
+    def start_profiling(self, sock):
+        """Uses the parameters received from the client to start profiling (see profile).
+        The file is written to profile_dir as the name the client sent (letters, digits, _ and - only)
+        with a .prof extension, and the request fails if it exists already."""
+        received = sock.recv_by_size().split("~", 2)
+        try:
+            kind, amount, name = received[0], received[1], received[2]
+            amount = int(amount) if kind == "requests" else float(amount)
+        except IndexError:
+            self._reply(sock, "ERROR~INCOMPLETE REQUEST~001~None")
+            return
+        except ValueError:
+            self._reply(sock, "ERROR~WRONG ARGUMENT~002~{}".format(received[1]))
+            return
+        if kind not in ("requests", "seconds") or amount <= 0:
+            self._reply(sock, "ERROR~WRONG ARGUMENT~002~{}".format(kind))
+            return
+        if self.profile_dir is None:
+            self._reply(sock, "ERROR~PROFILE DISABLED~009~None")
+            return
+        if not re.match(r"^[\w-]+$", name):
+            self._reply(sock, "ERROR~WRONG ARGUMENT~002~{}".format(name))
+            return
+        try:
+            started = self.profile(os.path.join(self.profile_dir, name + ".prof"), **{kind: amount})
+        except OSError:
+            self._reply(sock, "ERROR~WRONG ARGUMENT~002~{} exists".format(name))
+            return
+        self._reply(sock, SQLServer.success if started else SQLServer.failure)
+
+    def _sql_error(self, error):
+        """Returns the error answer for an sqlite3.Error raised while answering a request."""
+        if isinstance(error, SQL_ORM.QueryTimeout):
+            timer = getattr(self._timers, "current", None)     # None for the queries of html_http.
+            return "ERROR~TIMEOUT~007~{}".format(self.query_deadline if timer is None else timer.deadline)
+        if isinstance(error, SQL_ORM.ResultTooLarge):
+            self.memory.rejected(getattr(self._timers, "connection", None))
+            return "ERROR~RESPONSE TOO LARGE~006~{}".format(error)
+        return "ERROR~UNKNOWN~000~None"
+
+    def _decoded(self, table):
+        """Called by the request handlers once the request is parsed, to time the decoding of the request."""
+        timer = self._timers.current
+        timer.table = table if table in ("Players", "Teams", "Roster") else "other"
+        timer.mark("decode")
+
+    def _reply(self, sock, response, result=None, limited=True):
+        """Pickles the response and sends it to the client, timing both.
+        result is the part of response that can be an error (response itself if omitted).
+        If limited is True, a response bigger than max_response_size is replaced with an error."""
+        timer = self._timers.current
+        timer.mark("sql" if "decode" in timer.phases else "decode")
+        data = pickle.dumps(response, pickle.HIGHEST_PROTOCOL)
+        connection = getattr(self._timers, "connection", None)
+        if limited and self.max_response_size is not None and len(data) > self.max_response_size:
+            self.memory.rejected(connection)
+            response = result = "ERROR~RESPONSE TOO LARGE~006~{}".format(len(data))
+            data = pickle.dumps(response, pickle.HIGHEST_PROTOCOL)
+        timer.mark("serialize")
+        self.memory.hold(connection, len(data))
+        try:
+            sock.send_by_size(data)
+        finally:
+            self.memory.release(connection, len(data))
+        timer.mark("send")
+        result = response if result is None else result
+        if isinstance(result, basestring) and (result == SQLServer.failure or result.startswith("ERROR")):
+            timer.error = True
+
+    def send_pong(self, sock):
+        """Answers a PING request without using the DB, so clients can check their connection is alive."""
+        sock.recv_by_size()     # Empty, for every verb to have one frame of parameters.
+        self._reply(sock, SQLServer.pong)
+
+    def send_stats(self, sock):
+        """Sends the statistics about the server to the client,
+        in the Prometheus text format if the client asked for "prometheus" (see stats and prometheus)."""
+        if sock.recv_by_size() == "prometheus":
+            self._reply(sock, self.prometheus(), limited=False)
+        else:
+            self._reply(sock, self.stats(), limited=False)
 
     def send(self, sock):
         """Uses the parameters received from the client and SQL_ORM to send information to the client."""
-        received = sock.recv_by_size().split("~")
+        received = sock.recv_by_size().split("~", 2)    # The pickled constraints are last and may contain ~.
         table = received[0][0].upper() + received[0][1:].lower()
         try:
             ratio = received[1]
@@ -163,14 +598,85 @@ class SQLServer(Server):
         except IndexError:
             ratio = None
             constraints = None
+        self._decoded(table)
+        self._reply(sock, self.query(table, ratio, constraints))
+
+    def query(self, table, ratio=None, constraints=None):
+        """Returns the answer to a send request on the table, with the ratio and constraints (None for all rows).
+        The return value is a list with the objects, unless an error occurred, than a string is returned."""
         if table == "Players":
-            sock.send_by_size(pickle.dumps(self._handle_player_sends(ratio, constraints),
-                                           pickle.HIGHEST_PROTOCOL))
-        elif table == "Teams":
-            sock.send_by_size(pickle.dumps(self._handle_team_sends(ratio, constraints),
-                                           pickle.HIGHEST_PROTOCOL))
+            return self._handle_player_sends(ratio, constraints)
+        if table == "Teams":
+            return self._handle_team_sends(ratio, constraints)
+        if table == "Roster":
+            return self._handle_roster_sends(ratio, constraints)
+        return "ERROR~UNKNOWN TABLE~003~'%s'" % table
+
+    def send_conditional(self, sock):
+        """Like send, but the client also sends the version of the table it already has.
+        The answer is a (version, information) tuple, where information is SQLServer.not_modified
+        if the client's version is the current one."""
+        received = sock.recv_by_size().split("~", 3)
+        table = received[0][0].upper() + received[0][1:].lower()
+        client_version = None
+        try:
+            client_version = received[1]
+            ratio = received[2]
+            constraints = pickle.loads(received[3])
+        except IndexError:
+            ratio = None
+            constraints = None
+        self._decoded(table)
+        try:
+            version = self.version(table)
+        except KeyError:
+            self._reply(sock, "ERROR~UNKNOWN TABLE~003~'%s'" % table)
+            return
+        except sqlite3.Error as e:
+            self._reply(sock, self._sql_error(e))
+            return
+        if client_version == version:
+            self._reply(sock, (version, SQLServer.not_modified), SQLServer.not_modified)
         else:
-            sock.send_by_size(pickle.dumps("ERROR~UNKNOWN TABLE~003~'%s'" % table, pickle.HIGHEST_PROTOCOL))
+            response = self.query(table, ratio, constraints)
+            self._reply(sock, (version, response), response)
+
+    def negotiate_compression(self, sock):
+        """Chooses the first codec the client offers that the server allows, and answers with it (or None).
+        From then on, frames on the connection are in the compressed format (see Sock.set_codec)."""
+        offered = sock.recv_by_size().split(",")
+        allowed = self.compression or ()
+        chosen = next((codec for codec in offered if codec in allowed and codec in sock_module.CODECS), None)
+        self._reply(sock, chosen)
+        if chosen is not None:
+            sock.set_codec(chosen, self.compress_threshold, self.compression_stats)
+
+    def send_changes(self, sock):
+        """Uses the parameters received from the client to send it the changes to a table
+        after a changelog sequence (see SQL_ORM.ORM.changes_since).
+        A third argument "ids" asks for the ids of the changed rows only."""
+        received = sock.recv_by_size().split("~")
+        try:
+            table = received[0][0].upper() + received[0][1:].lower()
+            seq = int(received[1])
+            ids_only = received[2:3] == ["ids"]
+        except IndexError:
+            self._reply(sock, "ERROR~INCOMPLETE REQUEST~001~None")
+            return
+        except ValueError:
+            self._reply(sock, "ERROR~WRONG ARGUMENT~002~{}".format(received[1]))
+            return
+        self._decoded(table)
+        try:
+            if table == "Players":
+                response = self.orm.player.get_players_changes(seq, ids_only)
+            elif table == "Teams":
+                response = self.orm.team.get_teams_changes(seq, ids_only)
+            else:
+                response = "ERROR~UNKNOWN TABLE~003~'{}'".format(table)
+        except sqlite3.Error as e:
+            response = self._sql_error(e)
+        self._reply(sock, response)
 
     def _handle_player_sends(self, ratio=None, constraints=None):
         """Returns the information for send requests on the Players table.
@@ -183,12 +689,35 @@ class SQLServer(Server):
                     constraints["team_id"] = self.orm.team.get_teams(name=constraints["team_id"])[0].id
             except KeyError:
                 pass    # teams_id not in list.
+            except IndexError:
+                return "ERROR~TEAM NOT RECOGNIZED~005~{}".format(constraints["team_id"])
             for key in constraints:
                 if not isinstance(constraints[key], basestring):
                     return self.orm.player.get_players(ratio, **constraints)    # Cannot use contains, not string.
             return self.orm.player.get_players_contains(**constraints)
-        except sqlite3.Error:
-            return "ERROR~UNKNOWN~000~None"
+        except sqlite3.Error as e:
+            return self._sql_error(e)
+
+    def _handle_roster_sends(self, ratio=None, constraints=None):
+        """Returns the information for send requests on the Roster table, which has every player with its team.
+        The return value is a list with (sql.Player, sql.Team) tuples, unless an error occurred,
+        than a string is returned."""
+        try:
+            if None in (ratio, constraints):
+                return self.orm.roster.get_roster()
+            try:
+                if isinstance(constraints["team_id"], basestring):
+                    constraints["team_id"] = self.orm.team.get_teams(name=constraints["team_id"])[0].id
+            except KeyError:
+                pass    # teams_id not in list.
+            except IndexError:
+                return "ERROR~TEAM NOT RECOGNIZED~005~{}".format(constraints["team_id"])
+            for key in constraints:
+                if not isinstance(constraints[key], basestring):
+                    return self.orm.roster.get_roster(ratio, **constraints)    # Cannot use contains, not string.
+            return self.orm.roster.get_roster_contains(**constraints)
+        except sqlite3.Error as e:
+            return self._sql_error(e)
 
     def _handle_team_sends(self, ratio=None, constraints=None):
         """Returns the information for send requests on the Teams table.
@@ -200,25 +729,27 @@ class SQLServer(Server):
                 if not isinstance(constraints[key], basestring):
                     return self.orm.team.get_teams(ratio, **constraints)    # Cannot use contains, not string.
             return self.orm.team.get_teams_contains(**constraints)
-        except sqlite3.Error:
-            return "ERROR~UNKNOWN~000~None"
+        except sqlite3.Error as e:
+            return self._sql_error(e)
 
     def add(self, sock):
         """Uses parameter received from the client to add a row to the DB."""
-        received = sock.recv_by_size().split("~")
+        received = sock.recv_by_size().split("~", 1)
         try:
             table = received[0][0].upper() + received[0][1:].lower()
             values = pickle.loads(received[1])
-            values["id"] = None
+            values["id"] = None     # SQLite assigns it.
         except (IndexError, KeyError):
-            sock.send_by_size(pickle.dumps("ERROR~INCOMPLETE REQUEST~004~None", pickle.HIGHEST_PROTOCOL))
+            self._reply(sock, "ERROR~INCOMPLETE REQUEST~004~None")
             return
+        self._decoded(table)
         if table == "Players":
-            sock.send_by_size(pickle.dumps(self._handle_player_adds(values), pickle.HIGHEST_PROTOCOL))
+            response = self._handle_player_adds(values)
         elif table == "Teams":
-            sock.send_by_size(pickle.dumps(self._handle_team_adds(values), pickle.HIGHEST_PROTOCOL))
+            response = self._handle_team_adds(values)
         else:
-            sock.send_by_size(pickle.dumps("ERROR~UNKNOWN TABLE~003~'{}'".format(table), pickle.HIGHEST_PROTOCOL))
+            response = "ERROR~UNKNOWN TABLE~003~'{}'".format(table)
+        self._reply(sock, response)
 
     def _handle_player_adds(self, values):
         """Try to add the player to the DB based on information from the client."""
@@ -228,8 +759,8 @@ class SQLServer(Server):
             if self.orm.player.add_player(SQL_ORM.PlayerORM.dict_to_object(values)):
                 return SQLServer.success
             return SQLServer.failure
-        except sqlite3.Error:
-            return "ERROR~UNKNOWN~000~None"
+        except sqlite3.Error as e:
+            return self._sql_error(e)
         except KeyError:
             return "ERROR~INCOMPLETE DICT~004~None"
         except IndexError:
@@ -246,23 +777,25 @@ class SQLServer(Server):
 
     def update(self, sock):
         """Uses parameter received from the client to update a row in the DB."""
-        received = sock.recv_by_size().split("~")
+        received = sock.recv_by_size().split("~", 2)
         try:
             table = received[0][0].upper() + received[0][1:].lower()
             obj_id = int(received[1])
             updates = pickle.loads(received[2])
         except IndexError:
-            sock.send_by_size(pickle.dumps("ERROR~INCOMPLETE REQUEST~001~None", pickle.HIGHEST_PROTOCOL))
+            self._reply(sock, "ERROR~INCOMPLETE REQUEST~001~None")
             return
         except TypeError:
-            sock.send_by_size(pickle.dumps("ERROR~WRONG ARGUMENT~002~{}".format(received[1]), pickle.HIGHEST_PROTOCOL))
+            self._reply(sock, "ERROR~WRONG ARGUMENT~002~{}".format(received[1]))
             return
+        self._decoded(table)
         if table == "Players":
-            sock.send_by_size(pickle.dumps(self._handle_player_updates(obj_id, **updates), pickle.HIGHEST_PROTOCOL))
+            response = self._handle_player_updates(obj_id, **updates)
         elif table == "Teams":
-            sock.send_by_size(pickle.dumps(self._handle_team_updates(obj_id, **updates), pickle.HIGHEST_PROTOCOL))
+            response = self._handle_team_updates(obj_id, **updates)
         else:
-            sock.send_by_size(pickle.dumps("ERROR~UNKNOWN TABLE~003~'{}'".format(table), pickle.HIGHEST_PROTOCOL))
+            response = "ERROR~UNKNOWN TABLE~003~'{}'".format(table)
+        self._reply(sock, response)
 
     def _handle_player_updates(self, player_id, **updates):
         """Try to update the player on the DB based on information from the client."""
@@ -270,8 +803,8 @@ class SQLServer(Server):
             if self.orm.player.update_player(player_id, **updates):
                 return SQLServer.success
             return SQLServer.failure
-        except sqlite3.Error:
-            return "ERROR~UNKNOWN~000~None"
+        except sqlite3.Error as e:
+            return self._sql_error(e)
 
     def _handle_team_updates(self, team_id, **updates):
         """Try to update the team on the DB based on information from the client."""
@@ -279,8 +812,8 @@ class SQLServer(Server):
             if self.orm.team.update_team(team_id, **updates):
                 return SQLServer.success
             return SQLServer.failure
-        except sqlite3.Error:
-            return "ERROR~UNKNOWN~000~None"
+        except sqlite3.Error as e:
+            return self._sql_error(e)
 
     def delete(self, sock):
         """Uses parameter received from the client to delete rows from the DB."""
@@ -289,14 +822,16 @@ class SQLServer(Server):
             table = received[0][0].upper() + received[0][1:].lower()
             obj_id = int(received[1])
         except (IndexError, KeyError):
-            sock.send_by_size(pickle.dumps("ERROR~INCOMPLETE REQUEST~004~None", pickle.HIGHEST_PROTOCOL))
+            self._reply(sock, "ERROR~INCOMPLETE REQUEST~004~None")
             return
+        self._decoded(table)
         if table == "Players":
-            sock.send_by_size(pickle.dumps(self._handle_player_deletes(obj_id), pickle.HIGHEST_PROTOCOL))
+            response = self._handle_player_deletes(obj_id)
         elif table == "Teams":
-            sock.send_by_size(pickle.dumps(self._handle_team_deletes(obj_id), pickle.HIGHEST_PROTOCOL))
+            response = self._handle_team_deletes(obj_id)
         else:
-            sock.send_by_size(pickle.dumps("ERROR~UNKNOWN TABLE~003~'{}'".format(table), pickle.HIGHEST_PROTOCOL))
+            response = "ERROR~UNKNOWN TABLE~003~'{}'".format(table)
+        self._reply(sock, response)
 
     def _handle_player_deletes(self, player_id):
         """Try to delete the player on the DB based on information from the client."""
@@ -304,8 +839,8 @@ class SQLServer(Server):
             if self.orm.player.delete_player(player_id):
                 return SQLServer.success
             return SQLServer.failure
-        except sqlite3.Error:
-            return "ERROR~UNKNOWN~000~None"
+        except sqlite3.Error as e:
+            return self._sql_error(e)
 
     def _handle_team_deletes(self, team_id):
         """Try to delete the team on the DB based on information from the client."""
@@ -313,14 +848,139 @@ class SQLServer(Server):
             if self.orm.team.delete_team(team_id):
                 return SQLServer.success
             return SQLServer.failure
-        except sqlite3.Error:
-            return "ERROR~UNKNOWN~000~None"
+        except sqlite3.Error as e:
+            return self._sql_error(e)
 
+    def subscribe(self, sock):
+        """Uses the parameters received from the client to subscribe it to the changes of a table.
+        Once the client is answered, the connection only carries the events pushed to it,
+        until the client disconnects."""
+        received = sock.recv_by_size().split("~", 2)
+        table = received[0][0].upper() + received[0][1:].lower()
+        try:
+            ratio = received[1]
+            constraints = pickle.loads(received[2])
+        except IndexError:
+            ratio = None
+            constraints = None
+        self._decoded(table)
+        if table not in ("Players", "Teams"):
+            self._reply(sock, "ERROR~UNKNOWN TABLE~003~'%s'" % table)
+            return
+        try:
+            if table == "Players" and isinstance(constraints["team_id"], basestring):
+                constraints["team_id"] = self.orm.team.get_teams(name=constraints["team_id"])[0].id
+        except (KeyError, TypeError):
+            pass    # teams_id not in constraints.
+        except IndexError:
+            self._reply(sock, "ERROR~TEAM NOT RECOGNIZED~005~{}".format(constraints["team_id"]))
+            return
+        subscription = Subscription(table, ratio, constraints, self.subscriber_queue_size)
+        with self._subscriptions_lock:
+            self._subscriptions.append(subscription)
+        try:
+            self._reply(sock, SQLServer.success)
+            self.metrics.record(self._timers.current)   # The events pushed after it are not a part of the request.
+            self._push_events(sock, subscription)
+        finally:
+            with self._subscriptions_lock:
+                self._subscriptions.remove(subscription)
 
-class SQLClient(Client):
-    """A class that makes it easy to communicate with the SQLServer."""
+    @staticmethod
+    def _push_events(sock, subscription):
+        """Sends the events of the subscription to the client until it disconnects."""
+        while True:
+            try:
+                event = subscription.events.get(timeout=SQLServer.subscription_check_interval)
+            except Queue.Empty:
+                if sock.peer_closed():
+                    raise socket.error("Subscriber disconnected.")
+                continue
+            sock.send_by_size(pickle.dumps(event, pickle.HIGHEST_PROTOCOL))
+
+    def has_subscribers(self, table):
+        """Returns whether a client is subscribed to the changes of the table."""
+        with self._subscriptions_lock:
+            return any(subscription.table == table for subscription in self._subscriptions)
+
+    def _publish(self, action, table, rows):
+        """ORM listener that passes the changed rows to the subscriptions of the table."""
+        if table == "Players":
+            to_object, to_dict = SQL_ORM.PlayerORM.sql_to_object, SQL_ORM.PlayerORM.object_to_dict
+        elif table == "Teams":
+            to_object, to_dict = SQL_ORM.TeamORM.sql_to_object, SQL_ORM.TeamORM.object_to_dict
+        else:
+            return
+        with self._subscriptions_lock:
+            subscriptions = [subscription for subscription in self._subscriptions if subscription.table == table]
+        if not subscriptions:
+            return
+        for row in rows:
+            obj = to_object(row)
+            values = to_dict(obj)
+            for subscription in subscriptions:
+                subscription.offer(action, obj, values)
+
+
+class Subscription(object):
+    """The changes to a table that a client subscribed to on the SQLServer, waiting to be sent to it."""
+
+    resync = "RESYNC"
+
+    def __init__(self, table, ratio=None, constraints=None, max_events=1000):
+        """table is the name of the table.
+        ratio and constraints filter the rows like on SQLServer.send (None for all the rows).
+        max_events is the number of events kept until they are sent, after that the subscription
+        drops all of them and keeps a single Subscription.resync event instead."""
+        self.table = table
+        self.ratio = ratio
+        self.constraints = constraints
+        self.events = Queue.Queue(max_events)
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def matches(self, values):
+        """Returns whether the row (a dict like SQL_ORM's object_to_dict) fits the subscription's constraints.
+        If all the constraints are strings, the row's values need to contain them, like get_contains."""
+        if not self.constraints:
+            return True
+        try:
+            if all(isinstance(value, basestring) for value in self.constraints.itervalues()):
+                return all(value.lower() in unicode(values[key]).lower()
+                           for key, value in self.constraints.iteritems())
+            if self.ratio == SQLClient.bigger:
+                return all(values[key] > value for key, value in self.constraints.iteritems())
+            if self.ratio == SQLClient.smaller:
+                return all(values[key] < value for key, value in self.constraints.iteritems())
+            return all(values[key] == value for key, value in self.constraints.iteritems())
+        except KeyError:
+            return False    # Not a column of the table.
+
+    def offer(self, action, obj, values):
+        """Queue an (action, obj) event if values fits the subscription.
+        Never blocks, if the queue is full the events are replaced by a resync event."""
+        if not self.matches(values):
+            return
+        with self._lock:
+            try:
+                self.events.put_nowait((action, obj))
+            except Queue.Full:
+                while True:
+                    try:
+                        if self.events.get_nowait()[0] != Subscription.resync:
+                            self.dropped += 1
+                    except Queue.Empty:
+                        break
+                self.dropped += 1
+                self.events.put_nowait((Subscription.resync, None))
+
+
+class BaseSQLClient(Client):
+    """The requests a client sends the SQLServer and the reading of their answers,
+    shared by SQLClient and PipelinedSQLClient, which wait for the answers each their own way."""
 
     get = "GET"
+    conditional_get = "GETIF"
     equal = "="
     bigger = ">"
     smaller = "<"
@@ -328,25 +988,45 @@ class SQLClient(Client):
     add_str = "ADD"
     update_str = "UPDATE"
     delete_str = "DELETE"
+    subscribe_str = "SUBSCRIBE"
+    changes_str = "CHANGES"
+    tag_str = "TAG"
+    compress_str = "COMPRESS"
+    stats_str = "STATS"
+    profile_str = "PROFILE"
+    no_reply_str = "NOREPLY"
+    deadline_str = "DEADLINE"
+    ping_str = "PING"
 
-    def __init__(self, (ip, port)):
-        """Create a new SQLClient object.
-        (ip, port) is the ip and port combination you would pass to socket.bind."""
-        super(SQLClient, self).__init__((ip, port))
+    def __init__(self, address, compression=None, deadline=None):
+        """Create a new client. address, compression and deadline are like on SQLClient."""
+        super(BaseSQLClient, self).__init__(address)
+        self.compression = compression
+        self.deadline = deadline
 
-    def receive(self, table, ratio="=", **constraints):
-        """Receive information from the server. table is the type of information.
-        ratio - Should it be Client.equal\Client.bigger\Client.smaller than the provided value.
-        constraints is like on SQL_ORM.
-        Returns the information received back from the server.
-        In case server sent back an error, ValueError is raised with information from the server as description."""
-        self._send_receive_request(table, ratio, **constraints)
-        return self._receive_receive_request()
+    def connect(self):
+        """Connect to the server, and agree on a codec if compression was asked for."""
+        super(BaseSQLClient, self).connect()
+        if self.compression:
+            try:
+                self.sock.send_by_size(BaseSQLClient.compress_str)
+                self.sock.send_by_size(",".join(self.compression))
+                codec = pickle.loads(self.sock.recv_by_size())
+            except socket.error:
+                raise socket.error("Could not agree on compression with the server.")
+            if codec is not None:
+                self.sock.set_codec(codec)
+
+    def _send_query_verb(self, verb):
+        """Sends the verb of a request that runs a query, after the deadline if there is one."""
+        if self.deadline is not None:
+            self.sock.send_by_size(BaseSQLClient.deadline_str + "~" + repr(float(self.deadline)))
+        self.sock.send_by_size(verb)
 
     def _send_receive_request(self, table, ratio="=", **constraints):
         """Constructs the message to be sent for a receive request to the server and sends it."""
         try:
-            self.sock.send_by_size(SQLClient.get)
+            self._send_query_verb(BaseSQLClient.get)
             if not constraints:
                 self.sock.send_by_size(str(table)[0].upper() + str(table)[1:].lower())
             else:
@@ -357,74 +1037,132 @@ class SQLClient(Client):
         except pickle.PicklingError:
             raise pickle.PicklingError("Could not pickle values.")
 
-    def _receive_receive_request(self):
-        """Receives the answer to a receive request from the server."""
+    @staticmethod
+    def _receive_answer(answer):
+        """Returns the information in the answer to a receive request."""
         try:
-            info = pickle.loads(self.sock.recv_by_size())
-            if isinstance(info, basestring):
-                err = info.split("~")
-                raise ValueError("ERROR %s. Information: %s" % (err[1], err[3]))
-        except socket.error:
-            raise socket.error("Could not receive information from the server.")
+            info = pickle.loads(answer)
         except pickle.UnpicklingError:
             raise pickle.UnpicklingError("Server could not send information.")
+        if isinstance(info, basestring):
+            err = info.split("~")
+            raise ValueError("ERROR %s. Information: %s" % (err[1], err[3]))
         return info
 
-    def add(self, table, **values):
-        """Add a row to the table on the server's DB.
-        Returns True for success, False for failure to add to DB."""
-        self._send_add_request(table, **values)
-        return self._server_execution_success()
+    def add_nowait(self, table, **values):
+        """Like add, but does not wait for the server to answer, so it cannot tell whether the row was added.
+        Later requests on the connection are answered after the server executed it.
+        If the server rejects it as busy (see SQLServer limiter and shedder) it closes the connection,
+        so the next request raises socket.error."""
+        self._send_unanswered(self._send_add_request, table, **values)
 
     def _send_add_request(self, table, **values):
         """Constructs the message to be sent for an add request to the server and sends it."""
         try:
-            self.sock.send_by_size(SQLClient.add_str)
+            self.sock.send_by_size(BaseSQLClient.add_str)
             self.sock.send_by_size(table + "~" + pickle.dumps(values, pickle.HIGHEST_PROTOCOL))
         except socket.error:
             raise socket.error("Could not send request to the server.")
         except pickle.PicklingError:
             raise pickle.PicklingError("Could not pickle values.")
 
-    def update(self, table, obj_id, **updates):
-        """Update information on the server.
-        Returns True for success, False for failure to add to DB."""
-        self._send_update_request(table, obj_id, **updates)
-        return self._server_execution_success()
+    def update_nowait(self, table, obj_id, **updates):
+        """Like update, but does not wait for the server to answer. See add_nowait help."""
+        self._send_unanswered(self._send_update_request, table, obj_id, **updates)
 
     def _send_update_request(self, table, obj_id, **updates):
         """Constructs the message to be sent to update DB on the server."""
         try:
-            self.sock.send_by_size(SQLClient.update_str)
+            self.sock.send_by_size(BaseSQLClient.update_str)
             self.sock.send_by_size(table + "~" + str(obj_id) + "~" + pickle.dumps(updates, pickle.HIGHEST_PROTOCOL))
         except socket.error:
             raise socket.error("Could not send request to the server.")
         except pickle.PicklingError:
             raise pickle.PicklingError("Could not pickle values.")
 
-    def delete(self, table, obj_id):
-        """Delete information from the server's DB.
-        Returns True for success, False for failure to delete from DB."""
-        self._send_delete_request(table, obj_id)
-        return self._server_execution_success()
+    def delete_nowait(self, table, obj_id):
+        """Like delete, but does not wait for the server to answer. See add_nowait help."""
+        self._send_unanswered(self._send_delete_request, table, obj_id)
+
+    def _send_unanswered(self, send, *args, **kwargs):
+        """Sends a request with send(*args, **kwargs), marked so the server does not answer it."""
+        try:
+            self.sock.send_by_size(BaseSQLClient.no_reply_str)
+        except socket.error:
+            raise socket.error("Could not send request to the server.")
+        send(*args, **kwargs)
 
     def _send_delete_request(self, table, obj_id):
         """Constructs the message to be sent to delete from the DB on the server."""
         try:
-            self.sock.send_by_size(SQLClient.delete_str)
+            self.sock.send_by_size(BaseSQLClient.delete_str)
             self.sock.send_by_size(table + "~" + str(obj_id))
         except socket.error:
             raise socket.error("Could not send request to the server.")
         except pickle.PicklingError:
             raise pickle.PicklingError("Could not pickle values.")
 
-    def _server_execution_success(self):
-        """Receives the server's response and
-        returns whether the server successfully executed a non-receive request based on response."""
+    def _send_changes_request(self, table, seq=0, ids_only=False):
+        """Constructs the message to be sent for a changes request to the server and sends it."""
+        try:
+            self._send_query_verb(BaseSQLClient.changes_str)
+            self.sock.send_by_size(str(table) + "~" + str(seq) + ("~ids" if ids_only else ""))
+        except socket.error:
+            raise socket.error("Could not send request to the server.")
+
+    def _send_stats_request(self, prometheus=False):
+        """Sends a stats request to the server."""
+        try:
+            self.sock.send_by_size(BaseSQLClient.stats_str)
+            self.sock.send_by_size("prometheus" if prometheus else "")
+        except socket.error:
+            raise socket.error("Could not send request to the server.")
+
+    @staticmethod
+    def _stats_answer(answer):
+        """Returns the statistics in the answer to a stats request."""
+        try:
+            return pickle.loads(answer)
+        except (pickle.UnpicklingError, EOFError):
+            raise pickle.UnpicklingError("Server could not send information.")
+
+    def _send_profile_request(self, name, requests=None, seconds=None):
+        """Constructs the message to be sent for a profile request to the server and sends it."""
+        kind, amount = ("requests", requests) if requests is not None else ("seconds", seconds)
         try:
-            response = pickle.loads(self.sock.recv_by_size())
+            self.sock.send_by_size(BaseSQLClient.profile_str)
+            self.sock.send_by_size(kind + "~" + str(amount) + "~" + str(name))
         except socket.error:
+            raise socket.error("Could not send request to the server.")
+
+    def _send_ping_request(self):
+        """Sends a PING request to the server."""
+        try:
+            self.sock.send_by_size(BaseSQLClient.ping_str)
+            self.sock.send_by_size("")
+        except socket.error:
+            raise socket.error("Could not send request to the server.")
+
+    @staticmethod
+    def _pong(answer):
+        """Raises socket.error if the answer to a PING request is not SQLServer.pong."""
+        if answer == "" or pickle.loads(answer) != SQLServer.pong:
             raise socket.error("Could not receive answer from the server.")
+
+    @staticmethod
+    def retry_after(error):
+        """Returns the seconds the server asked to wait before sending the request again,
+        if error (raised by a request) is a BUSY error, otherwise None."""
+        message = str(error)
+        if message.startswith("ERROR BUSY. Information: "):
+            return float(message.rsplit(" ", 1)[1])
+        return None
+
+    @staticmethod
+    def _execution_success(answer):
+        """Returns whether the answer says the server successfully executed a non-receive request."""
+        try:
+            response = pickle.loads(answer)
         except pickle.UnpicklingError:
             raise pickle.UnpicklingError("Server could not send information")
         if response == SQLServer.success:
@@ -436,3 +1174,367 @@ class SQLClient(Client):
             raise socket.error("ERROR %s. Information: %s" % (err[1], err[3]))
         else:
             raise socket.error("Could not receive information from the server.")
+
+
+class SQLClient(BaseSQLClient):
+    """A class that makes it easy to communicate with the SQLServer."""
+
+    cache_size = 256    # Answers receive keeps with the cache on.
+
+    def __init__(self, address, cache=False, compression=None, deadline=None):
+        """Create a new SQLClient object.
+        address is the (ip, port) combination you would pass to socket.bind,
+        or the path of the unix domain socket the server listens on.
+        If cache is True, receive keeps the answers it got, and only asks the server
+        to send them again when the table changed on the server.
+        The cache keeps the cache_size answers used last.
+        compression is a sequence of codecs (keys of sock.CODECS) to offer the server on connect,
+        the preferred first. Large frames are compressed with the one the server chooses.
+        deadline is the most seconds the server may run the SQL of a receive or changes request for,
+        after that it is aborted and ValueError is raised with the TIMEOUT error (None for the server's limit)."""
+        super(SQLClient, self).__init__(address, compression, deadline)
+        self._cache = collections.OrderedDict() if cache else None
+
+    def receive(self, table, ratio="=", **constraints):
+        """Receive information from the server. table is the type of information.
+        ratio - Should it be Client.equal\Client.bigger\Client.smaller than the provided value.
+        constraints is like on SQL_ORM.
+        Returns the information received back from the server.
+        In case server sent back an error, ValueError is raised with information from the server as description.
+        With the cache on, the returned objects are shared with the cache, so do not change them."""
+        if self._cache is None:
+            self._send_receive_request(table, ratio, **constraints)
+            return self._receive_receive_request()
+        table = str(table)[0].upper() + str(table)[1:].lower()
+        key = (table, ratio if constraints else None, tuple(sorted(constraints.iteritems())))
+        version, info = self._cache.pop(key, ("", None))
+        self._send_conditional_request(table, version, ratio, **constraints)
+        version, new_info = self._receive_conditional_request()
+        if new_info != SQLServer.not_modified:
+            info = new_info
+        self._cache[key] = (version, info)  # Last, as the most recently used.
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return list(info)
+
+    def clear_cache(self):
+        """Forget all the answers kept by receive."""
+        if self._cache is not None:
+            self._cache.clear()
+
+    def _send_conditional_request(self, table, version, ratio="=", **constraints):
+        """Constructs the message to be sent for a conditional receive request to the server and sends it."""
+        try:
+            self._send_query_verb(SQLClient.conditional_get)
+            if not constraints:
+                self.sock.send_by_size(table + "~" + version)
+            else:
+                self.sock.send_by_size(table + "~" + version + "~" + str(ratio) + "~"
+                                       + pickle.dumps(constraints, pickle.HIGHEST_PROTOCOL))
+        except socket.error:
+            raise socket.error("Could not send request to the server.")
+        except pickle.PicklingError:
+            raise pickle.PicklingError("Could not pickle values.")
+
+    def _receive_conditional_request(self):
+        """Receives the (version, information) answer to a conditional receive request from the server."""
+        try:
+            answer = pickle.loads(self.sock.recv_by_size())
+        except socket.error:
+            raise socket.error("Could not receive information from the server.")
+        except pickle.UnpicklingError:
+            raise pickle.UnpicklingError("Server could not send information.")
+        if isinstance(answer, basestring):
+            err = answer.split("~")
+            raise ValueError("ERROR %s. Information: %s" % (err[1], err[3]))
+        version, info = answer
+        if isinstance(info, basestring) and info != SQLServer.not_modified:
+            err = info.split("~")
+            raise ValueError("ERROR %s. Information: %s" % (err[1], err[3]))
+        return version, info
+
+    def _receive_receive_request(self):
+        """Receives the answer to a receive request from the server."""
+        try:
+            answer = self.sock.recv_by_size()
+        except socket.error:
+            raise socket.error("Could not receive information from the server.")
+        if answer == "":
+            raise socket.error("The server closed the connection.")
+        return SQLClient._receive_answer(answer)
+
+    def add(self, table, **values):
+        """Add a row to the table on the server's DB.
+        Returns True for success, False for failure to add to DB."""
+        self._send_add_request(table, **values)
+        return self._server_execution_success()
+
+    def update(self, table, obj_id, **updates):
+        """Update information on the server.
+        Returns True for success, False for failure to add to DB."""
+        self._send_update_request(table, obj_id, **updates)
+        return self._server_execution_success()
+
+    def delete(self, table, obj_id):
+        """Delete information from the server's DB.
+        Returns True for success, False for failure to delete from DB."""
+        self._send_delete_request(table, obj_id)
+        return self._server_execution_success()
+
+    def changes(self, table, seq=0, ids_only=False):
+        """Receive the changes to a table since the changelog sequence seq.
+        Returns a (seq, objects, deleted) tuple, where seq should be passed the next time,
+        objects is a list with the added or updated rows and deleted is a list with the ids of deleted rows.
+        When seq is 0 or too old for the server to know what changed, objects is the full table
+        and deleted is None, meaning everything received before should be replaced.
+        If ids_only is True, objects has the ids of the rows instead (None instead of the full table),
+        for clients that only need to know what to forget.
+        In case server sent back an error, ValueError is raised with information from the server as description."""
+        self._send_changes_request(table, seq, ids_only)
+        return self._receive_receive_request()
+
+    def stats(self, prometheus=False):
+        """Returns the statistics about the server as a dict (see SQLServer.stats),
+        or as a string in the Prometheus text format if prometheus is True."""
+        self._send_stats_request(prometheus)
+        try:
+            answer = self.sock.recv_by_size()
+        except socket.error:
+            raise socket.error("Could not receive information from the server.")
+        return SQLClient._stats_answer(answer)
+
+    def profile(self, name, requests=None, seconds=None):
+        """Ask the server to profile the next requests requests of all clients, or their requests in the next
+        seconds seconds, and write the statistics to name.prof in its profile_dir (see SQLServer.start_profiling).
+        Returns True if it started, False if a profile is running already.
+        In case server sent back an error (profiling is disabled, or the name is taken or not allowed),
+        socket.error is raised with information from the server as description."""
+        self._send_profile_request(name, requests, seconds)
+        return self._server_execution_success()
+
+    def subscribe(self, table, ratio="=", **constraints):
+        """Subscribe to the changes of a table on the server.
+        ratio and constraints are like on receive, and limit the changes to the rows that fit them.
+        Returns True for success, False for failure.
+        After subscribing, the connection is only used for the events (see next_event),
+        so use another client for other requests."""
+        self._send_subscribe_request(table, ratio, **constraints)
+        return self._server_execution_success()
+
+    def _send_subscribe_request(self, table, ratio="=", **constraints):
+        """Constructs the message to be sent for a subscribe request to the server and sends it."""
+        try:
+            self.sock.send_by_size(SQLClient.subscribe_str)
+            if not constraints:
+                self.sock.send_by_size(str(table)[0].upper() + str(table)[1:].lower())
+            else:
+                self.sock.send_by_size(str(table)[0].upper() + str(table)[1:].lower() + "~" + str(ratio) + "~"
+                                       + pickle.dumps(constraints, pickle.HIGHEST_PROTOCOL))
+        except socket.error:
+            raise socket.error("Could not send request to the server.")
+        except pickle.PicklingError:
+            raise pickle.PicklingError("Could not pickle values.")
+
+    def next_event(self, timeout=None):
+        """Wait for the next change the server pushes after subscribe, and return it as an (action, obj) tuple.
+        action is SQLClient.add_str, SQLClient.update_str or SQLClient.delete_str and obj is the changed
+        Player/Team (as it was before the change for deletes).
+        If this client was too slow and events were dropped, action is Subscription.resync and obj is None,
+        and the table should be received again (from another client).
+        Returns None if timeout seconds passed without a change (None waits forever)."""
+        try:
+            if timeout is not None and not select.select([self.sock], [], [], timeout)[0]:
+                return None
+            data = self.sock.recv_by_size()
+            if data == "":
+                raise socket.error
+            return pickle.loads(data)
+        except socket.error:
+            raise socket.error("Could not receive information from the server.")
+        except pickle.UnpicklingError:
+            raise pickle.UnpicklingError("Server could not send information.")
+
+    def ping(self):
+        """Checks the connection to the server is alive, and keeps it from being idle (see SQLServer idle_timeout).
+        Returns the seconds the answer took. Raises socket.error if the server did not answer."""
+        start = time.time()
+        self._send_ping_request()
+        try:
+            answer = self.sock.recv_by_size()
+        except socket.error:
+            raise socket.error("Could not receive answer from the server.")
+        SQLClient._pong(answer)
+        return time.time() - start
+
+    def _server_execution_success(self):
+        """Receives the server's response and
+        returns whether the server successfully executed a non-receive request based on response."""
+        try:
+            answer = self.sock.recv_by_size()
+        except socket.error:
+            raise socket.error("Could not receive answer from the server.")
+        if answer == "":
+            raise socket.error("The server closed the connection.")
+        return SQLClient._execution_success(answer)
+
+
+class PipelinedSQLClient(BaseSQLClient):
+    """A client like SQLClient that can have many requests waiting for their answers on the same connection.
+    Every request is tagged with an id, and a background thread matches the answers to the requests by it,
+    so requests do not wait for the answers to the requests before them.
+    The *_async methods send a request and return a Reply right away,
+    receive, add, update and delete wait for the answer like on SQLClient.
+    It has no subscribe, as a subscription takes the whole connection: use an SQLClient for it.
+    Can be used by many threads at once."""
+
+    def __init__(self, address, compression=None, deadline=None):
+        """Create a new PipelinedSQLClient object.
+        address, compression and deadline are like on SQLClient."""
+        super(PipelinedSQLClient, self).__init__(address, compression=compression, deadline=deadline)
+        self._replies = {}
+        self._replies_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._next_tag = 0
+        self._closed = False
+        self._reader = None
+
+    def connect(self):
+        """Connect to the server and start receiving answers."""
+        if self._reader is not None:
+            self._reader.join()     # The reader of the connection closed by reconnect.
+        super(PipelinedSQLClient, self).connect()
+        self._closed = False
+        self._reader = threading.Thread(target=self._read_replies, args=(self.sock, ))
+        self._reader.daemon = True
+        self._reader.start()
+
+    def changes(self, table, seq=0, ids_only=False):
+        """See SQLClient.changes help."""
+        return self._request(BaseSQLClient._receive_answer, self._send_changes_request, table, seq,
+                             ids_only).result()
+
+    def stats(self, prometheus=False):
+        """See SQLClient.stats help."""
+        return self._request(BaseSQLClient._stats_answer, self._send_stats_request, prometheus).result()
+
+    def profile(self, name, requests=None, seconds=None):
+        """See SQLClient.profile help."""
+        return self._request(BaseSQLClient._execution_success, self._send_profile_request, name, requests,
+                             seconds).result()
+
+    def ping(self):
+        """See SQLClient.ping help."""
+        start = time.time()
+        self._request(BaseSQLClient._pong, self._send_ping_request).result()
+        return time.time() - start
+
+    def receive(self, table, ratio="=", **constraints):
+        """See SQLClient.receive help."""
+        return self.receive_async(table, ratio, **constraints).result()
+
+    def receive_async(self, table, ratio="=", **constraints):
+        """Send a receive request and return its Reply. See SQLClient.receive help."""
+        return self._request(BaseSQLClient._receive_answer, self._send_receive_request, table, ratio, **constraints)
+
+    def add(self, table, **values):
+        """See SQLClient.add help."""
+        return self.add_async(table, **values).result()
+
+    def add_async(self, table, **values):
+        """Send an add request and return its Reply. See SQLClient.add help."""
+        return self._request(BaseSQLClient._execution_success, self._send_add_request, table, **values)
+
+    def update(self, table, obj_id, **updates):
+        """See SQLClient.update help."""
+        return self.update_async(table, obj_id, **updates).result()
+
+    def update_async(self, table, obj_id, **updates):
+        """Send an update request and return its Reply. See SQLClient.update help."""
+        return self._request(BaseSQLClient._execution_success, self._send_update_request, table, obj_id, **updates)
+
+    def delete(self, table, obj_id):
+        """See SQLClient.delete help."""
+        return self.delete_async(table, obj_id).result()
+
+    def delete_async(self, table, obj_id):
+        """Send a delete request and return its Reply. See SQLClient.delete help."""
+        return self._request(BaseSQLClient._execution_success, self._send_delete_request, table, obj_id)
+
+    def _send_unanswered(self, send, *args, **kwargs):
+        """See BaseSQLClient._send_unanswered help. Holds the send lock, so other threads' requests are not mixed in."""
+        with self._send_lock:
+            super(PipelinedSQLClient, self)._send_unanswered(send, *args, **kwargs)
+
+    def _request(self, parse, send, *args, **kwargs):
+        """Sends a tagged request with send(*args, **kwargs) and returns the Reply that parse will read."""
+        reply = Reply(parse)
+        with self._send_lock:
+            with self._replies_lock:
+                if self._closed:
+                    raise socket.error("Could not send request to the server.")
+                tag = self._next_tag
+                self._next_tag += 1
+                self._replies[tag] = reply
+            try:
+                self.sock.send_by_size(BaseSQLClient.tag_str + "~" + str(tag))
+                send(*args, **kwargs)
+            except (socket.error, pickle.PicklingError):
+                with self._replies_lock:
+                    self._replies.pop(tag, None)
+                raise
+        return reply
+
+    def _read_replies(self, sock):
+        """Receives the answers from the server on sock and passes them to their Reply objects,
+        until disconnected."""
+        while True:
+            try:
+                data = sock.recv_by_size()
+            except socket.error:
+                break
+            if data == "":
+                break
+            tag, answer = data.split("~", 1)
+            with self._replies_lock:
+                reply = self._replies.pop(int(tag), None)
+            if reply is not None:
+                reply.set(answer)
+        with self._replies_lock:
+            self._closed = True
+            replies = self._replies.values()
+            self._replies.clear()
+        for reply in replies:
+            reply.fail(socket.error("Could not receive answer from the server."))
+
+
+class Reply(object):
+    """The answer to a request sent by a PipelinedSQLClient, which might not have arrived yet."""
+    def __init__(self, parse):
+        """parse is called with the answer from the server to get the result."""
+        self._parse = parse
+        self._event = threading.Event()
+        self._answer = None
+        self._error = None
+
+    def done(self):
+        """Returns whether the answer arrived."""
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the answer and return it like the matching SQLClient method would.
+        If timeout (seconds) is not None and passed before the answer arrived, socket.timeout is raised."""
+        if not self._event.wait(timeout):
+            raise socket.timeout("The server did not answer yet.")
+        if self._error is not None:
+            raise self._error
+        return self._parse(self._answer)
+
+    def set(self, answer):
+        """Called with the answer from the server when it arrives."""
+        self._answer = answer
+        self._event.set()
+
+    def fail(self, error):
+        """Called when the answer will never arrive, result will raise error."""
+        self._error = error
+        self._event.set()
@@ -0,0 +1,84 @@
+import json
+import Queue
+import random
+import sqlite3
+import threading
+import time
+
+
+class SlowQueryLog(object):
+    """Logs the queries of an SQL_ORM.ORM that took at least threshold seconds, as JSON lines.
+    Every line has the SQL, a summary of its parameters, the number of rows, the duration and
+    the EXPLAIN QUERY PLAN of the query. Only the check of the duration is done by the thread that
+    ran the query, the plan is found and the line is written by a background thread."""
+
+    max_params = 10         # Parameters summarised in a line.
+    max_param_length = 50   # Longest repr of a parameter in a line.
+
+    def __init__(self, db_path, out, threshold=0.1, sample_rate=1.0, max_queue=1000):
+        """db_path is the DB file the queries run on, to find their plans with.
+        out is the path of the file to append the lines to, or an object with write and flush methods.
+        Only a sample_rate fraction (0 to 1) of the slow queries is logged.
+        Up to max_queue slow queries wait for the background thread, after that they are counted
+        in dropped instead of slowing the queries down."""
+        self.db_path = db_path
+        self.out = out
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.dropped = 0
+        self.logged = 0
+        self._queue = Queue.Queue(max_queue)
+        self._thread = threading.Thread(target=self._write_entries)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def observe(self, query, values, rows, seconds):
+        """Called after every query with its SQL, its parameters, the number of rows it returned or changed
+        (None if unknown) and the seconds it took."""
+        if seconds < self.threshold or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return
+        try:
+            self._queue.put_nowait((time.time(), query, values, rows, seconds))
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=None):
+        """Write the queries waiting for the background thread, and stop it."""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _write_entries(self):
+        """The background thread, which writes the entries until close is called."""
+        conn = sqlite3.connect(self.db_path)
+        f = open(self.out, "a") if isinstance(self.out, basestring) else self.out
+        try:
+            while True:
+                entry = self._queue.get()
+                if entry is None:
+                    break
+                logged_at, query, values, rows, seconds = entry
+                f.write(json.dumps({"time": logged_at, "sql": query, "params": self._summary(values), "rows": rows,
+                                    "seconds": seconds, "plan": self._plan(conn, query, values)}) + "\n")
+                f.flush()
+                self.logged += 1
+        finally:
+            conn.close()
+            if f is not self.out:
+                f.close()
+
+    @staticmethod
+    def _plan(conn, query, values):
+        """Returns the details of the EXPLAIN QUERY PLAN of the query as a list of strings,
+        or a list with the error if it could not be explained."""
+        try:
+            return [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + query, values)]
+        except sqlite3.Error as e:
+            return ["ERROR: %s" % e]
+
+    @staticmethod
+    def _summary(values):
+        """Returns a list with the short reprs of the first parameters of a query."""
+        summary = [repr(value)[:SlowQueryLog.max_param_length] for value in values[:SlowQueryLog.max_params]]
+        if len(values) > SlowQueryLog.max_params:
+            summary.append("... %d more" % (len(values) - SlowQueryLog.max_params))
+        return summary
@@ -1,16 +1,95 @@
 __author__ = "Omer Dekel"
 
 import socket
+import select
+import threading
+import time
+import zlib
 
 
 HEADER_SIZE = 8
 
+RAW_FLAG = "-"
+COMPRESSED_FLAG = "z"
+
+
+def _zlib_decompress(data, limit):
+    """Decompress data, that must be one whole zlib stream of at most limit bytes once decompressed.
+    Raises socket.error otherwise, without decompressing more than limit bytes."""
+    decompressor = zlib.decompressobj()
+    try:
+        s = decompressor.decompress(data, limit)
+        if decompressor.unconsumed_tail:
+            raise socket.error("Compressed frame of more than %d bytes." % limit)
+        s += decompressor.flush()
+    except zlib.error as e:
+        raise socket.error("Bad compressed frame: %s" % e)
+    if decompressor.unused_data or len(s) > limit:
+        raise socket.error("Bad compressed frame: data after its end.")
+    return s
+
+
+# Codecs a connection can compress with, name: (compress, decompress), decompress takes the data and a size limit.
+CODECS = {"zlib": (lambda s: zlib.compress(s, 6), _zlib_decompress),
+          "zlib-fast": (lambda s: zlib.compress(s, 1), _zlib_decompress)}
+
+
+class CompressionStats(object):
+    """Thread safe counters of the compression done by Sock objects."""
+    def __init__(self):
+        """Create a new CompressionStats object with all counters at 0."""
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.compress_time = 0.0
+        self.decompress_time = 0.0
+
+    def add_compressed(self, raw_size, compressed_size, seconds):
+        """Count a frame that was compressed from raw_size bytes to compressed_size bytes in seconds."""
+        with self._lock:
+            self.frames += 1
+            self.raw_bytes += raw_size
+            self.compressed_bytes += compressed_size
+            self.compress_time += seconds
+
+    def add_decompressed(self, seconds):
+        """Count the time it took to decompress a received frame."""
+        with self._lock:
+            self.decompress_time += seconds
+
+    def as_dict(self):
+        """Returns the counters as a dict."""
+        with self._lock:
+            return {"frames": self.frames, "raw_bytes": self.raw_bytes, "compressed_bytes": self.compressed_bytes,
+                    "compress_time": self.compress_time, "decompress_time": self.decompress_time}
+
 
 class Sock(socket.socket):
     """Class that is an extension of socket.socket."""
+    compress_threshold = 1024   # Smaller frames are never compressed.
+    copy_limit = 64 * 1024      # Bigger frames are sent after their header, instead of copied into one string with it.
+    max_frame_size = 10 ** HEADER_SIZE - 1  # Compressed frames are not decompressed past what a raw frame can hold.
+
     def __init__(self, *args, **kwargs):
         """Create a new Sock object."""
         super(Sock, self).__init__(*args, **kwargs)
+        self.codec = None
+        self.compression_stats = None
+        self.bytes_received = 0     # Of whole frames, headers included.
+        self.bytes_sent = 0
+
+    def set_codec(self, codec, compress_threshold=None, compression_stats=None):
+        """Start sending and receiving frames in the compressed format, with a flag after the size in the header.
+        codec is a key of CODECS, and both sides must set the same one at the same point in the communication.
+        Frames of at least compress_threshold bytes are compressed (if it makes them smaller).
+        If compression_stats (a CompressionStats object) is given, the compression is counted on it."""
+        if codec not in CODECS:
+            raise ValueError("Unknown codec '%s'." % codec)
+        self.codec = codec
+        if compress_threshold is not None:
+            self.compress_threshold = compress_threshold
+        self.compression_stats = compression_stats
 
     @classmethod
     def copy(cls, sock):
@@ -26,24 +105,75 @@ class Sock(socket.socket):
         default_socket.close()
         return sock, addr
 
+    def set_keepalive(self, idle=60, interval=10, count=5):
+        """Turn on TCP keepalive, so a peer that is gone without closing the connection is noticed:
+        after idle seconds with no traffic, count probes are sent interval seconds apart,
+        and if none is answered, the socket fails. The timing is only set where the system supports it."""
+        self.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", interval), ("TCP_KEEPCNT", count)):
+            if hasattr(socket, option):
+                self.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+    def peer_closed(self):
+        """Returns whether the other side closed the connection, without blocking."""
+        try:
+            if not select.select([self], [], [], 0)[0]:
+                return False
+            return self.recv(1, socket.MSG_PEEK) == ""
+        except (socket.error, select.error):
+            return True
+
     def recv_by_size(self):
         """Receives by size (with a pre-programmed header size).
-        The other side can use send_by_size to send the data."""
-        str_size = ""
-        str_size += self.recv(HEADER_SIZE)
-        if str_size == "":
+        The other side can use send_by_size to send the data.
+        Raises socket.error if a compressed frame is broken or bigger than max_frame_size."""
+        header_size = HEADER_SIZE if self.codec is None else HEADER_SIZE + 1
+        header = self.recv(header_size)
+        if header == "":
             return ""
-
-        while len(str_size) < HEADER_SIZE:
-            str_size += self.recv(HEADER_SIZE - len(str_size))
-        size = int(str_size)
-
-        data = ""
-        while len(data) < size:
-            data += self.recv(size - len(data))
+        header += self._recv_exactly(header_size - len(header))
+        data = self._recv_exactly(int(header[:HEADER_SIZE]))
+        self.bytes_received += header_size + len(data)
+        if self.codec is not None and header[HEADER_SIZE] == COMPRESSED_FLAG:
+            start = time.time()
+            data = CODECS[self.codec][1](data, self.max_frame_size)
+            if self.compression_stats is not None:
+                self.compression_stats.add_decompressed(time.time() - start)
         return data
 
+    def _recv_exactly(self, size):
+        """Receives exactly size bytes. Raises socket.error if the connection is closed first."""
+        chunks = []
+        while size > 0:
+            chunk = self.recv(size)
+            if chunk == "":
+                raise socket.error("Connection closed in the middle of a message.")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return "".join(chunks)
+
     def send_by_size(self, s):
         """Sends by size (with a pre-programmed header size).
         The other side can use recv_by_size to receive the data."""
-        self.sendall(str(len(s)).zfill(HEADER_SIZE) + s)
+        if self.codec is None:
+            self._send_frame(str(len(s)).zfill(HEADER_SIZE), s)
+            return
+        flag = RAW_FLAG
+        if len(s) >= self.compress_threshold:
+            start = time.time()
+            compressed = CODECS[self.codec][0](s)
+            if self.compression_stats is not None:
+                self.compression_stats.add_compressed(len(s), len(compressed), time.time() - start)
+            if len(compressed) < len(s):
+                s = compressed
+                flag = COMPRESSED_FLAG
+        self._send_frame(str(len(s)).zfill(HEADER_SIZE) + flag, s)
+
+    def _send_frame(self, header, s):
+        """Sends the header and then s, in one call if s is small."""
+        if len(s) < self.copy_limit:
+            self.sendall(header + s)
+        else:
+            self.sendall(header)
+            self.sendall(s)
+        self.bytes_sent += len(header) + len(s)